@@ -0,0 +1,61 @@
+"""
+Compares HTTP/1.1 and HTTP/2 for the upload client against the local fake
+DocuWare server over TLS. Both protocols run against the same server, which
+negotiates per connection via ALPN. With HTTP/1.1 every concurrent upload
+needs its own connection and TLS handshake; HTTP/2 multiplexes them over a
+few. Needs the h2 package and the openssl command line tool for the
+throwaway certificate.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+from bench_upload import add_arguments, percentile, run_benchmark
+
+
+def make_certificate(folder):
+    certfile = os.path.join(folder, "cert.pem")
+    keyfile = os.path.join(folder, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-keyout", keyfile, "-out", certfile, "-subj", "/CN=127.0.0.1",
+         "-addext", "subjectAltName=IP:127.0.0.1"],
+        check=True, capture_output=True
+    )
+    return certfile, keyfile
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(parser)
+    parser.add_argument("--max-connections", type=int, default=100, help="http.max_connections for both runs")
+    args = parser.parse_args()
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        sys.exit("HTTP/2 needs the h2 package: pip install httpx[http2]")
+
+    rows = []
+    with tempfile.TemporaryDirectory() as folder:
+        certfile, keyfile = make_certificate(folder)
+        for label, http2 in (("HTTP/1.1", False), ("HTTP/2", True)):
+            extra = {"http": {"http2": http2, "max_connections": args.max_connections}}
+            stats = run_benchmark(args, certfile, keyfile, extra)
+            rows.append((label, stats))
+
+    print(f"{args.files} files, {args.workers} workers, {args.latency_ms:.0f} ms latency, max {args.max_connections} connections")
+    print(f"{'protocol':<10} {'files/s':>8} {'MB/s':>7} {'p50 ms':>8} {'p99 ms':>8} {'failed':>7}  negotiated")
+    for label, stats in rows:
+        elapsed = stats["elapsed"]
+        print(
+            f"{label:<10} {stats['documents'] / elapsed:>8.1f} {stats['bytes'] / (1024 * 1024) / elapsed:>7.2f}"
+            f" {percentile(stats['latencies'], 50) * 1000:>8.1f} {percentile(stats['latencies'], 99) * 1000:>8.1f}"
+            f" {stats['failed']:>7}  {stats['protocols']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
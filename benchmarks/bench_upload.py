@@ -0,0 +1,124 @@
+"""
+End-to-end benchmark of restapi_upload_with_xml.main() against the local
+fake DocuWare server. Generates a synthetic inbox, runs one full upload
+pass and reports files/s, MB/s, p50/p99 upload latency and peak RSS.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import ssl
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import restapi_upload_with_xml as upload  # noqa: E402
+from corpus import generate_corpus  # noqa: E402
+from fake_docuware import start_in_process  # noqa: E402
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def add_arguments(parser):
+    parser.add_argument("--files", type=int, default=500)
+    parser.add_argument("--min-kb", type=int, default=50)
+    parser.add_argument("--max-kb", type=int, default=300)
+    parser.add_argument("--workers", type=int, default=20)
+    parser.add_argument("--chunk-kb", type=int, default=1024)
+    parser.add_argument("--small-threshold-kb", type=int, default=1024)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--bandwidth-mb-per-s", type=float, default=0.0, help="shared uplink in MB/s, 0 = unlimited")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--extra-config", default="{}", help="JSON merged into the generated config.json")
+
+
+def write_config(folder, port, args, scheme="http", cert_file="", extra=None):
+    config = {
+        "info": {
+            "folder_path": os.path.join(folder, "inbox"),
+            "backup_path": os.path.join(folder, "backup"),
+            "error_path": os.path.join(folder, "error"),
+        },
+        "restapi": {
+            "company_url": f"127.0.0.1:{port}",
+            "scheme": scheme,
+            "file_cabinet_guid": "00000000-0000-0000-0000-000000000000",
+            "username": "bench",
+            "password": "bench",
+            "cert_file": cert_file,
+            "organization": "Benchmark",
+        },
+        "logs": {"log_level": "INFO"},
+        "debug": {"chunk_size": args.chunk_kb * 1024, "temp_solution": 0, "fiddler": 0},
+        "paths": {"temp_path": os.path.join(folder, "temp")},
+        "upload": {
+            "workers": args.workers,
+            "small_file_threshold_kb": args.small_threshold_kb,
+            "retry_backoff_seconds": 0.05,
+        },
+    }
+    for overrides in (json.loads(args.extra_config), extra or {}):
+        for section, values in overrides.items():
+            config.setdefault(section, {}).update(values)
+    config_path = os.path.join(folder, "config.json")
+    with open(config_path, "w") as f:
+        json.dump(config, f, indent=2)
+    return config_path
+
+
+def run_benchmark(args, certfile=None, keyfile=None, extra=None):
+    # One full pass of main() on a fresh inbox; returns the server statistics
+    # plus wall time and failed pairs
+    with tempfile.TemporaryDirectory() as folder:
+        generate_corpus(os.path.join(folder, "inbox"), args.files, args.min_kb * 1024, args.max_kb * 1024)
+        server, port = start_in_process(
+            args.latency_ms / 1000, args.bandwidth_mb_per_s * 1024 * 1024, args.error_rate,
+            certfile=certfile, keyfile=keyfile
+        )
+        scheme = "https" if certfile else "http"
+        try:
+            config_path = write_config(folder, port, args, scheme, certfile or "", extra)
+            started = time.perf_counter()
+            asyncio.run(upload.main(config_path))
+            elapsed = time.perf_counter() - started
+            context = ssl.create_default_context(cafile=certfile) if certfile else None
+            with urllib.request.urlopen(f"{scheme}://127.0.0.1:{port}/_stats", context=context) as response:
+                stats = json.load(response)
+        finally:
+            server.terminate()
+        stats["failed"] = sum(len(files) for _, _, files in os.walk(os.path.join(folder, "error"))) // 2
+    stats["elapsed"] = elapsed
+    return stats
+
+
+def print_report(stats):
+    latencies = stats["latencies"]
+    elapsed = stats["elapsed"]
+    print(f"files        {stats['documents']} uploaded, {stats['failed']} failed")
+    print(f"wall time    {elapsed:.2f} s")
+    print(f"throughput   {stats['documents'] / elapsed:.1f} files/s, {stats['bytes'] / (1024 * 1024) / elapsed:.2f} MB/s")
+    print(f"latency      p50 {percentile(latencies, 50) * 1000:.1f} ms, p99 {percentile(latencies, 99) * 1000:.1f} ms")
+    print(f"requests     {stats['requests']} ({stats['errors_injected']} errors injected)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(parser)
+    args = parser.parse_args()
+    print_report(run_benchmark(args))
+    peak_rss = upload.get_peak_rss()
+    if peak_rss is not None:
+        print(f"peak RSS     {peak_rss / (1024 * 1024):.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
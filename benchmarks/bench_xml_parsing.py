@@ -0,0 +1,63 @@
+"""
+Compares the xmltodict and lxml parsing engines on a synthetic corpus,
+inline on the event loop and in a thread/process pool.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import restapi_upload_with_xml as upload  # noqa: E402
+from corpus import generate_corpus  # noqa: E402
+
+
+async def parse_all(folder, names, executor, engine, workers):
+    sem = asyncio.Semaphore(max(1, workers) * 2)
+
+    async def one(name):
+        async with sem:
+            return await upload.get_data_from_xml(folder, name, executor, engine)
+
+    return await asyncio.gather(*(one(n) for n in names))
+
+
+def run(folder, names, engine, executor_kind, workers):
+    executor = upload.create_parse_executor(executor_kind, workers)
+    try:
+        started = time.perf_counter()
+        results = asyncio.run(parse_all(folder, names, executor, engine, workers))
+        elapsed = time.perf_counter() - started
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return results, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--positions", type=int, default=20, help="Positionen per Vorgang (XML size)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        names = generate_corpus(folder, args.files, min_size=1, max_size=1, positions=args.positions)
+        baseline = None
+        print(f"{'engine':<10} {'executor':<8} {'seconds':>8} {'files/s':>10}")
+        for engine in ("xmltodict", "lxml"):
+            for kind in ("none", "thread", "process"):
+                results, elapsed = run(folder, names, engine, kind, args.workers)
+                if baseline is None:
+                    baseline = results
+                elif results != baseline:
+                    raise SystemExit(f"{engine}/{kind} produced different data than xmltodict/none")
+                print(f"{engine:<10} {kind:<8} {elapsed:>8.2f} {len(names) / elapsed:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Synthetic Dokument/Vorgang corpus for the benchmarks.
+Produces XML + binary pairs shaped like the PDS export in folder_path.
+"""
+
+import os
+import random
+import uuid
+from datetime import datetime, timedelta
+
+DOKUMENT_TYPEN = ["Eingangsrechnung", "Angebot", "Auftragsbestaetigung", "Lieferschein", "Ausgangsrechnung"]
+VORGANG_TYPEN = ["EingangsRechnungImpl", "AuftragImpl", "AngebotImpl", "LieferscheinImpl"]
+
+
+def make_xml(index, file_name, rng, positions=20):
+    created = datetime(2024, 6, 10, 13, 48, 28) + timedelta(minutes=index)
+    dokument_typ = rng.choice(DOKUMENT_TYPEN)
+    vorgaenge = []
+    for v in range(rng.randint(1, 3)):
+        vorgangstyp = "EingangsRechnungImpl" if dokument_typ == "Eingangsrechnung" and v == 0 else rng.choice(VORGANG_TYPEN)
+        partner_nr = "Lieferantennummer" if vorgangstyp == "EingangsRechnungImpl" else "Kundennummer"
+        lines = "".join(
+            f"<Position><Nr>{p}</Nr><Artikel>ART-{rng.randint(1000, 9999)}</Artikel><Menge>{rng.randint(1, 50)}</Menge>"
+            f"<Preis>{rng.uniform(1, 500):.2f}</Preis><Text>Position {p} fuer Vorgang {v}</Text></Position>"
+            for p in range(positions)
+        )
+        vorgaenge.append(
+            f"<Vorgang><Vorgangstyp>{vorgangstyp}</Vorgangstyp>"
+            f"<Belegdatum>{created.date().isoformat()}T00:00:00+02:00</Belegdatum>"
+            f"<Projektnummer>{rng.randint(1000, 9999)}</Projektnummer>"
+            f"<Geschaeftspartner><{partner_nr}>{rng.randint(10000, 99999)}</{partner_nr}><Name>Partner {index}-{v}</Name></Geschaeftspartner>"
+            f"<Positionen>{lines}</Positionen></Vorgang>"
+        )
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        f"<Dokument><DokumentID>{index}</DokumentID><Belegnummer>BN{index:07d}</Belegnummer>"
+        f"<Filename>{file_name}</Filename>"
+        f"<Erfassungspartition_dbid>{rng.choice(['1801', '1802'])}</Erfassungspartition_dbid>"
+        f"<Dokumenttyp>{dokument_typ}</Dokumenttyp><Bemerkung>Synthetischer Beleg {index}</Bemerkung>"
+        f"<Netto>{rng.uniform(10, 10000):.2f}</Netto><Created>{created.isoformat()}.848+02:00</Created>"
+        + "".join(vorgaenge) + "</Dokument>"
+    )
+
+
+def generate_corpus(folder, count, min_size=50*1024, max_size=300*1024, positions=20, seed=42):
+    # Writes `count` XML/binary pairs into `folder` and returns the XML names
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    xml_names = []
+    for i in range(count):
+        stem = f"Beleg_{i:06d}_{uuid.UUID(int=rng.getrandbits(128))}"
+        file_name = stem + ".pdf"
+        with open(os.path.join(folder, file_name), "wb") as f:
+            size = rng.randint(min_size, max_size)
+            f.write(b"%PDF-1.4\n")
+            f.write(rng.randbytes(max(0, size - 9)))
+        xml_name = f"{uuid.UUID(int=rng.getrandbits(128))}.xml"
+        with open(os.path.join(folder, xml_name), "w", encoding="utf-8") as f:
+            f.write(make_xml(i, file_name, rng, positions))
+        xml_names.append(xml_name)
+    return xml_names
@@ -0,0 +1,416 @@
+"""
+Local stand-in for the DocuWare platform REST API, just enough for
+restapi_upload_with_xml.main(): token, chunked and multipart uploads,
+and the Fields PUT. Latency, a shared uplink bandwidth and error
+injection are configurable, and GET /_stats returns per-document timings.
+
+Plain HTTP is served by a threading HTTP/1.1 server. With a certificate
+the server speaks TLS and negotiates HTTP/2 or HTTP/1.1 via ALPN, which
+needs the h2 package (h11 ships with httpx).
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import re
+import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DOCUMENTS_RE = re.compile(r"^/docuware/platform/FileCabinets/([^/]+)/Documents$")
+CHUNK_RE = re.compile(r"^/docuware/platform/FileCabinets/([^/]+)/Documents/Upload/(\d+)$")
+FIELDS_RE = re.compile(r"^/docuware/platform/FileCabinets/([^/]+)/Documents/(\d+)/Fields$")
+
+FINAL_DOCUMENT = (
+    '<?xml version="1.0" encoding="utf-8"?>'
+    '<Document xmlns="http://dev.docuware.com/schema/public/services/platform" '
+    'xmlns:s="http://dev.docuware.com/schema/public/services">'
+    '<Fields><Field FieldName="DWDOCID"><Int>{doc_id}</Int></Field></Fields></Document>'
+)
+CHUNK_DOCUMENT = (
+    '<?xml version="1.0" encoding="utf-8"?>'
+    '<Document xmlns="http://dev.docuware.com/schema/public/services/platform" '
+    'xmlns:s="http://dev.docuware.com/schema/public/services">'
+    '<FileChunk Finished="false" BytesWritten="{written}">'
+    '<s:Links><s:Link rel="next" href="{href}" /></s:Links></FileChunk></Document>'
+)
+
+
+def text(status, body):
+    return status, "text/plain", body, {}
+
+
+class DocuWareState:
+    # Uploads, documents and counters shared by every connection, whichever
+    # protocol it speaks. handle() blocks for the simulated latency and
+    # bandwidth, so it runs on a worker thread.
+
+    def __init__(self, latency=0.0, bandwidth=0.0, error_rate=0.0, seed=1):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.link_busy_until = 0.0
+        self.next_id = 1
+        self.uploads = {}
+        self.documents = {}
+        self.requests = 0
+        self.errors = 0
+        self.protocols = {}
+
+    def new_id(self):
+        with self.lock:
+            doc_id = self.next_id
+            self.next_id += 1
+            return doc_id
+
+    def transfer(self, size):
+        # Models one uplink shared by all connections
+        if not self.bandwidth:
+            return
+        with self.lock:
+            start = max(time.monotonic(), self.link_busy_until)
+            self.link_busy_until = start + size / self.bandwidth
+            wait = self.link_busy_until - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+    def inject_error(self):
+        with self.lock:
+            self.requests += 1
+            if self.error_rate and self.rng.random() < self.error_rate:
+                self.errors += 1
+                return True
+        return False
+
+    def stats(self):
+        with self.lock:
+            latencies = [d["finished"] - d["started"] for d in self.documents.values() if d.get("finished")]
+            return {
+                "requests": self.requests,
+                "errors_injected": self.errors,
+                "documents": len(latencies),
+                "bytes": sum(d["size"] for d in self.documents.values() if d.get("finished")),
+                "latencies": latencies,
+                "protocols": dict(self.protocols),
+            }
+
+    def handle(self, method, path, headers, body, started, protocol="HTTP/1.1"):
+        # Returns (status, content type, body, extra headers). `headers` has
+        # lower-case names; the client joins base_url and FileChunk hrefs into
+        # "//docuware/...", so repeated slashes are collapsed first.
+        route = re.sub(r"/{2,}", "/", path.split("?", 1)[0])
+        if method == "GET":
+            if route == "/_stats":
+                return 200, "application/json", json.dumps(self.stats()), {}
+            return text(404, "Not Found")
+        if method == "POST" and route.endswith("/Account/Token"):
+            return 200, "application/json", json.dumps({"access_token": "fake-token", "expires_in": 3600, "token_type": "bearer"}), {}
+
+        with self.lock:
+            self.protocols[protocol] = self.protocols.get(protocol, 0) + 1
+        self.transfer(len(body))
+        if self.latency:
+            time.sleep(self.latency)
+        if self.inject_error():
+            return 503, "text/plain", "Service Unavailable", {"Retry-After": "0"}
+
+        if method == "PUT":
+            return self._index(route, body)
+        if method != "POST":
+            return text(405, "Method Not Allowed")
+        if headers.get("content-type", "").startswith("multipart/form-data"):
+            if DOCUMENTS_RE.match(route) is None:
+                return text(404, "Not Found")
+            doc_id = self.new_id()
+            with self.lock:
+                self.documents[doc_id] = {"started": started, "finished": time.monotonic(), "size": len(body)}
+            return 200, "application/json", json.dumps({"Id": doc_id}), {}
+        return self._chunk(route, headers, body, started)
+
+    def _chunk(self, route, headers, body, started):
+        match = DOCUMENTS_RE.match(route) or CHUNK_RE.match(route)
+        if match is None:
+            return text(404, "Not Found")
+        total = int(headers.get("x-file-size") or 0)
+        if CHUNK_RE.match(route):
+            upload_id = int(match.group(2))
+            with self.lock:
+                upload = self.uploads.get(upload_id)
+            if upload is None:
+                return text(404, "Upload not found")
+        else:
+            upload_id = self.new_id()
+            upload = {"received": 0, "started": started}
+            with self.lock:
+                self.uploads[upload_id] = upload
+        upload["received"] += len(body)
+        if upload["received"] < total:
+            href = f"/docuware/platform/FileCabinets/{match.group(1)}/Documents/Upload/{upload_id}"
+            return 200, "application/xml", CHUNK_DOCUMENT.format(written=upload["received"], href=href), {}
+        with self.lock:
+            self.uploads.pop(upload_id, None)
+            self.documents[upload_id] = {"started": upload["started"], "size": upload["received"]}
+        return 200, "application/xml", FINAL_DOCUMENT.format(doc_id=upload_id), {}
+
+    def _index(self, route, body):
+        match = FIELDS_RE.match(route)
+        if match is None:
+            return text(404, "Not Found")
+        doc_id = int(match.group(2))
+        with self.lock:
+            document = self.documents.get(doc_id)
+            if document is not None:
+                document["finished"] = time.monotonic()
+        fields = json.loads(body or b"{}").get("Field", [])
+        return 200, "application/json", json.dumps({"Field": fields}), {}
+
+
+class FakeDocuWare(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, state):
+        super().__init__(address, Handler)
+        self.state = state
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _dispatch(self, method):
+        started = time.monotonic()
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        headers = {k.lower(): v for k, v in self.headers.items()}
+        status, content_type, payload, extra = self.server.state.handle(method, self.path, headers, body, started)
+        payload = payload.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in extra.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PUT(self):
+        self._dispatch("PUT")
+
+
+# ---------------------------
+# TLS server (HTTP/2 or HTTP/1.1 via ALPN)
+# ---------------------------
+
+class H11Connection(asyncio.Protocol):
+    def __init__(self, state):
+        import h11
+        self.h11 = h11
+        self.state = state
+        self.conn = h11.Connection(h11.SERVER)
+        self.request = None
+        self.body = bytearray()
+        self.started = 0.0
+        self.busy = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.conn.receive_data(data)
+        self._next_events()
+
+    def _next_events(self):
+        h11 = self.h11
+        while not self.busy:
+            try:
+                event = self.conn.next_event()
+            except h11.RemoteProtocolError:
+                self.transport.close()
+                return
+            if event is h11.NEED_DATA or event is h11.PAUSED:
+                return
+            if isinstance(event, h11.Request):
+                self.request = event
+                self.body = bytearray()
+                self.started = time.monotonic()
+            elif isinstance(event, h11.Data):
+                self.body += event.data
+            elif isinstance(event, h11.EndOfMessage):
+                self.busy = True
+                asyncio.ensure_future(self._respond())
+            elif isinstance(event, h11.ConnectionClosed):
+                self.transport.close()
+                return
+
+    async def _respond(self):
+        h11 = self.h11
+        request = self.request
+        headers = {k.decode().lower(): v.decode() for k, v in request.headers}
+        status, content_type, payload, extra = await asyncio.to_thread(
+            self.state.handle, request.method.decode(), request.target.decode(), headers, bytes(self.body), self.started
+        )
+        payload = payload.encode("utf-8")
+        response_headers = [("Content-Type", content_type), ("Content-Length", str(len(payload)))]
+        response_headers += list(extra.items())
+        self.transport.write(self.conn.send(h11.Response(status_code=status, headers=response_headers)))
+        self.transport.write(self.conn.send(h11.Data(data=payload)))
+        self.transport.write(self.conn.send(h11.EndOfMessage()))
+        if self.conn.our_state is h11.MUST_CLOSE:
+            self.transport.close()
+            return
+        self.conn.start_next_cycle()
+        self.busy = False
+        self._next_events()
+
+
+class H2Connection(asyncio.Protocol):
+    def __init__(self, state):
+        import h2.config
+        import h2.connection
+        import h2.events
+        import h2.settings
+        self.events = h2.events
+        self.state = state
+        self.conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False, header_encoding="utf-8"))
+        self.settings = h2.settings.SettingCodes
+        self.streams = {}
+        self.window_open = asyncio.Event()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.conn.initiate_connection()
+        # Large windows, otherwise every chunk stalls on WINDOW_UPDATE round trips
+        self.conn.update_settings({self.settings.INITIAL_WINDOW_SIZE: 16 * 1024 * 1024, self.settings.MAX_CONCURRENT_STREAMS: 256})
+        self.conn.increment_flow_control_window(64 * 1024 * 1024)
+        self.transport.write(self.conn.data_to_send())
+
+    def data_received(self, data):
+        events = self.events
+        for event in self.conn.receive_data(data):
+            if isinstance(event, events.RequestReceived):
+                self.streams[event.stream_id] = {"headers": dict(event.headers), "body": bytearray(), "started": time.monotonic()}
+            elif isinstance(event, events.DataReceived):
+                self.streams[event.stream_id]["body"] += event.data
+                self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, events.StreamEnded):
+                asyncio.ensure_future(self._respond(event.stream_id, self.streams.pop(event.stream_id)))
+            elif isinstance(event, events.WindowUpdated):
+                self.window_open.set()
+            elif isinstance(event, events.ConnectionTerminated):
+                self.transport.close()
+        self.transport.write(self.conn.data_to_send())
+
+    async def _respond(self, stream_id, request):
+        headers = {k.lower(): v for k, v in request["headers"].items() if not k.startswith(":")}
+        status, content_type, payload, extra = await asyncio.to_thread(
+            self.state.handle, request["headers"][":method"], request["headers"][":path"], headers,
+            bytes(request["body"]), request["started"], "HTTP/2"
+        )
+        payload = payload.encode("utf-8")
+        response_headers = [(":status", str(status)), ("content-type", content_type), ("content-length", str(len(payload)))]
+        response_headers += [(k.lower(), v) for k, v in extra.items()]
+        self.conn.send_headers(stream_id, response_headers)
+        while payload:
+            window = min(self.conn.local_flow_control_window(stream_id), self.conn.max_outbound_frame_size)
+            if window <= 0:
+                self.transport.write(self.conn.data_to_send())
+                self.window_open.clear()
+                await self.window_open.wait()
+                continue
+            self.conn.send_data(stream_id, payload[:window])
+            payload = payload[window:]
+        self.conn.end_stream(stream_id)
+        self.transport.write(self.conn.data_to_send())
+
+
+class ALPNConnection(asyncio.Protocol):
+    # Hands the connection to the HTTP/2 or HTTP/1.1 protocol, whichever the
+    # TLS handshake picked
+    def __init__(self, state):
+        self.state = state
+        self.inner = None
+
+    def connection_made(self, transport):
+        ssl_object = transport.get_extra_info("ssl_object")
+        protocol = ssl_object.selected_alpn_protocol() if ssl_object else None
+        self.inner = H2Connection(self.state) if protocol == "h2" else H11Connection(self.state)
+        self.inner.connection_made(transport)
+
+    def data_received(self, data):
+        self.inner.data_received(data)
+
+    def connection_lost(self, exc):
+        pass
+
+
+def serve_tls(host, port, state, certfile, keyfile, ready=None):
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(certfile, keyfile)
+    context.set_alpn_protocols(["h2", "http/1.1"])
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        # One thread per in-flight request, like the threading server
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=256))
+        server = await loop.create_server(lambda: ALPNConnection(state), host, port, ssl=context)
+        if ready is not None:
+            ready.put(server.sockets[0].getsockname()[1])
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(run())
+
+
+def serve(host, port, latency, bandwidth, error_rate, ready=None, certfile=None, keyfile=None):
+    state = DocuWareState(latency, bandwidth, error_rate)
+    if certfile:
+        serve_tls(host, port, state, certfile, keyfile, ready)
+        return
+    server = FakeDocuWare((host, port), state)
+    if ready is not None:
+        ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_in_process(latency=0.0, bandwidth=0.0, error_rate=0.0, host="127.0.0.1", certfile=None, keyfile=None):
+    # Runs the server in its own process so it does not share the GIL with the
+    # code under test; returns (process, port)
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=serve, args=(host, 0, latency, bandwidth, error_rate, ready, certfile, keyfile), daemon=True
+    )
+    process.start()
+    return process, ready.get(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--bandwidth-mb-per-s", type=float, default=0.0, help="shared uplink in MB/s, 0 = unlimited")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument("--certfile", help="serve TLS (HTTP/2 and HTTP/1.1) with this certificate")
+    parser.add_argument("--keyfile")
+    args = parser.parse_args()
+    scheme = "https" if args.certfile else "http"
+    print(f"Fake DocuWare on {scheme}://{args.host}:{args.port}")
+    serve(args.host, args.port, args.latency_ms / 1000, args.bandwidth_mb_per_s * 1024 * 1024, args.error_rate,
+          certfile=args.certfile, keyfile=args.keyfile)
+
+
+if __name__ == "__main__":
+    main()
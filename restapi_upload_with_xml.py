@@ -1,20 +1,39 @@
 import os
+import sys
 import shutil
 import xmltodict
 from lxml import etree
 import logging
+import logging.handlers
+import queue
+import copy
+import atexit
 from datetime import datetime, timezone, timedelta
 import json
 import httpx
 import mimetypes
 import asyncio
+import argparse
 import urllib.parse
+import hashlib
+import functools
+import re
+import errno
+import zipfile
+import tarfile
+import sqlite3
+import threading
+import time
+import random
+import email.utils
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 """
 Refactor notes:
 - Replaced cookie-based login with OAuth token-based auth (Bearer).
 - Added CONFIG global derived from read_config().
 - Implemented ensure_token / load_token / is_token_expired / get_token from your snippet.
+- TokenManager replaces ensure_token: token cached in memory, refreshed once for all uploads (single-flight) over the shared AsyncClient.
 - Async HTTPX clients now send Authorization headers (and refresh if 401).
 - Removed cookie file usage and login() calls.
 - Kept existing upload logic (chunk + index) but with token auth.
@@ -28,35 +47,177 @@ Refactor notes:
 def read_config(path):
     with open(path) as f:
         config = json.load(f)
+    return parse_config(config)
 
+
+def parse_config(config):
     data = {
-        'folder_path': config["info"].get("folder_path", ""),
-        'backup_path': config["info"].get("backup_path", ""),
-        'error_path': config["info"].get("error_path", ""),
-        'temp_solution': config["debug"].get("temp_solution", False),
-        'fiddler': config["debug"].get("fiddler", 0),
-        'cert_file_fiddler': config["debug"].get("cert_file_fiddler", ""),
-        'chunk_size': config["debug"].get("chunk_size", 1024*1024),
-        'company_url': config["restapi"].get("company_url", ""),
-        'file_cabinet_guid': config["restapi"].get("file_cabinet_guid", ""),
-        'username': config["restapi"].get("username", ""),
-        'password': config["restapi"].get("password", ""),
-        'cert_file': config["restapi"].get("cert_file", ""),
-        'organization': config["restapi"].get("organization", ""),
-        'log_level': config["logs"].get("log_level", ""),
+        'folder_path': config.get("info", {}).get("folder_path", ""),
+        'backup_path': config.get("info", {}).get("backup_path", ""),
+        'error_path': config.get("info", {}).get("error_path", ""),
+        'temp_solution': config.get("debug", {}).get("temp_solution", False),
+        'fiddler': config.get("debug", {}).get("fiddler", 0),
+        'cert_file_fiddler': config.get("debug", {}).get("cert_file_fiddler", ""),
+        'chunk_size': config.get("debug", {}).get("chunk_size", 1024*1024),
+        'company_url': config.get("restapi", {}).get("company_url", ""),
+        'scheme': config.get("restapi", {}).get("scheme", "https"),
+        'file_cabinet_guid': config.get("restapi", {}).get("file_cabinet_guid", ""),
+        'username': config.get("restapi", {}).get("username", ""),
+        'password': config.get("restapi", {}).get("password", ""),
+        'cert_file': config.get("restapi", {}).get("cert_file", ""),
+        'organization': config.get("restapi", {}).get("organization", ""),
+        'log_level': config.get("logs", {}).get("log_level", ""),
+        'log_max_bytes': int(config.get("logs", {}).get("max_size_mb", 10) * 1024 * 1024),
+        'log_backup_count': config.get("logs", {}).get("backup_count", 10),
+        'log_json_lines': config.get("logs", {}).get("json_lines", False),
         # Optional token-related settings
         'temp_path': config.get("paths", {}).get("temp_path", r"C:\\DTW\\temp"),
         'token_file': config.get("auth", {}).get("token_file", "auth_token.json"),
         'token_endpoint': config.get("auth", {}).get("token_endpoint", ""),
+        'token_refresh_margin': config.get("auth", {}).get("refresh_margin_seconds", 60),
+        # Optional upload scheduler settings
+        'upload_workers': config.get("upload", {}).get("workers", 20),
+        'max_uploads_per_host': config.get("upload", {}).get("max_per_host", 20),
+        'max_inflight_bytes': int(config.get("upload", {}).get("max_inflight_mb", 256) * 1024 * 1024),
+        'adaptive_chunks': config.get("upload", {}).get("adaptive_chunks", True),
+        'chunk_size_min': config.get("upload", {}).get("chunk_size_min", 256*1024),
+        'chunk_size_max': config.get("upload", {}).get("chunk_size_max", 16*1024*1024),
+        'chunk_target_seconds': config.get("upload", {}).get("chunk_target_seconds", 2.0),
+        'small_file_threshold': int(config.get("upload", {}).get("small_file_threshold_kb", 1024) * 1024),
+        'chunk_retries': config.get("upload", {}).get("chunk_retries", 3),
+        'retry_backoff': config.get("upload", {}).get("retry_backoff_seconds", 1.0),
+        'retry_backoff_max': config.get("upload", {}).get("retry_backoff_max_seconds", 30),
+        'retry_jitter': config.get("upload", {}).get("retry_jitter", True),
+        'retry_after_max': config.get("upload", {}).get("retry_after_max_seconds", 120),
+        # Optional circuit breaker and failed-document retry settings
+        'circuit_failure_threshold': config.get("circuit_breaker", {}).get("failure_threshold", 10),
+        'circuit_reset_seconds': config.get("circuit_breaker", {}).get("reset_seconds", 30),
+        'circuit_max_reset_seconds': config.get("circuit_breaker", {}).get("max_reset_seconds", 300),
+        'circuit_give_up_seconds': config.get("circuit_breaker", {}).get("give_up_seconds", 600),
+        'retry_failed_documents': config.get("retry", {}).get("enabled", True),
+        'retry_max_attempts': config.get("retry", {}).get("max_attempts", 3),
+        'retry_after_minutes': config.get("retry", {}).get("after_minutes", 15),
+        # Optional pipeline settings
+        'parse_workers': config.get("pipeline", {}).get("parse_workers", 4),
+        'pipeline_queue_size': config.get("pipeline", {}).get("queue_size", 100),
+        'incremental': config.get("pipeline", {}).get("incremental", True),
+        # Optional duplicate detection settings
+        'dedup_enabled': config.get("dedup", {}).get("enabled", True),
+        'dedup_ttl_days': config.get("dedup", {}).get("ttl_days", 90),
+        'dedup_max_entries': config.get("dedup", {}).get("max_entries", 100000),
+        'parse_engine': config.get("pipeline", {}).get("parse_engine", "lxml"),
+        # Optional watch-folder (service) settings
+        'watch_poll_interval': config.get("watch", {}).get("poll_interval_seconds", 5),
+        'watch_rescan_interval': config.get("watch", {}).get("rescan_seconds", 60),
+        'watch_settle_seconds': config.get("watch", {}).get("settle_seconds", 2),
+        'watch_report_minutes': config.get("watch", {}).get("report_minutes", 15),
+        'parse_executor': config.get("pipeline", {}).get("parse_executor", "thread"),
+        # Optional HTTP transport settings
+        'http2': config.get("http", {}).get("http2", False),
+        'http_max_connections': config.get("http", {}).get("max_connections", 100),
+        'http_max_keepalive': config.get("http", {}).get("max_keepalive_connections", 20),
+        'http_keepalive_expiry': config.get("http", {}).get("keepalive_expiry_seconds", 30),
+        'http_connect_timeout': config.get("http", {}).get("connect_timeout_seconds", 10),
+        'http_read_timeout': config.get("http", {}).get("read_timeout_seconds", 120),
+        'http_write_timeout': config.get("http", {}).get("write_timeout_seconds", 120),
+        'http_pool_timeout': config.get("http", {}).get("pool_timeout_seconds", 60),
+        # Optional index field mapping, replaces DEFAULT_FIELD_MAPPING
+        'index_fields': config.get("index_fields") or None,
+        # Optional archive settings
+        'archive_workers': config.get("archive", {}).get("workers", 4),
+        'archive_compress': config.get("archive", {}).get("compress", ""),
+        'archive_compress_after_days': config.get("archive", {}).get("compress_after_days", 1),
+        # Optional run metrics settings
+        'metrics_enabled': config.get("metrics", {}).get("enabled", True),
+        'metrics_prometheus_file': config.get("metrics", {}).get("prometheus_textfile", ""),
+        # Optional upload bandwidth limit in megabytes (MiB) per second, 0 = unlimited,
+        # windows override it by time of day
+        'bandwidth_limit': int(config.get("bandwidth", {}).get("limit_mb_per_s", 0) * 1024 * 1024),
+        'bandwidth_windows': config.get("bandwidth", {}).get("windows", []),
+        'bandwidth_burst': int(config.get("bandwidth", {}).get("burst_kb", 256) * 1024),
+        'bandwidth_inflight_seconds': config.get("bandwidth", {}).get("inflight_seconds", 5),
+        # Optional indexing settings: Fields PUT of chunked uploads in a separate stage
+        'indexing_deferred': config.get("indexing", {}).get("deferred", True),
+        'indexing_workers': config.get("indexing", {}).get("workers", 10),
     }
 
     # If token_endpoint is not provided, default to DocuWare token endpoint based on company_url
     if not data['token_endpoint'] and data['company_url']:
-        data['token_endpoint'] = f"https://{data['company_url']}/docuware/platform/Account/Token"
+        data['token_endpoint'] = f"{data['scheme']}://{data['company_url']}/docuware/platform/Account/Token"
 
     return data
 
 
+def merge_config(base, override):
+    # Section-wise merge: a profile only lists what differs from the base file
+    merged = dict(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = {**merged[key], **value}
+        else:
+            merged[key] = value
+    return merged
+
+
+# Sections that configure the shared transfer machinery (scheduler, HTTP
+# transport, retry policy, logging, metrics, bandwidth limiter, indexing
+# stage). They are read from the first config file only.
+GLOBAL_SECTIONS = ("upload", "http", "circuit_breaker", "logs", "metrics", "bandwidth", "indexing")
+
+
+def load_profiles(config_paths):
+    # Returns (global settings, [(profile name, settings), ...]). Every path is
+    # either a plain config.json (one profile named after the file) or a file
+    # with a "profiles" list whose entries are inline objects or paths to
+    # further config files, merged over the rest of that file. Settings that
+    # are shared by all profiles come from the first file; a profile that sets
+    # one of the GLOBAL_SECTIONS differently gets it listed under
+    # "ignored_sections" so main() can warn about it.
+    profiles = []
+    global_config = None
+    global_data = None
+
+    def profile_data(config):
+        data = parse_config(config)
+        data["ignored_sections"] = [
+            section for section in GLOBAL_SECTIONS if config.get(section, {}) != global_config.get(section, {})
+        ]
+        return data
+
+    for path in config_paths:
+        with open(path) as f:
+            config = json.load(f)
+        entries = config.pop("profiles", None)
+        if global_data is None:
+            global_config = config
+            global_data = parse_config(config)
+        if not entries:
+            profiles.append((os.path.splitext(os.path.basename(path))[0], profile_data(config)))
+            continue
+        for number, entry in enumerate(entries, 1):
+            if isinstance(entry, str):
+                entry_path = os.path.join(os.path.dirname(path), entry)
+                with open(entry_path) as f:
+                    entry = json.load(f)
+                entry.setdefault("name", os.path.splitext(os.path.basename(entry_path))[0])
+            entry = dict(entry)
+            name = entry.pop("name", None) or f"profil{number}"
+            profiles.append((name, profile_data(merge_config(config, entry))))
+
+    names = [name for name, _ in profiles]
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        raise ValueError(f"Profilnamen mehrfach vergeben: {', '.join(sorted(duplicates))}")
+    inboxes = [os.path.normcase(os.path.abspath(data["folder_path"])) for _, data in profiles]
+    if len(set(inboxes)) != len(inboxes):
+        raise ValueError("Jedes Profil braucht einen eigenen folder_path")
+    if len(profiles) > 1:
+        # Token file, journals and SQLite stores must not be shared by two cabinets
+        for name, data in profiles:
+            data["temp_path"] = os.path.join(data["temp_path"], re.sub(r"[^\w.-]", "_", name))
+    return global_data, profiles
+
+
 def set_log_level(level_name):
     return {
         'DEBUG': logging.DEBUG,
@@ -66,6 +227,93 @@ def set_log_level(level_name):
         'CRITICAL': logging.CRITICAL
     }.get(level_name.upper(), logging.DEBUG)
 
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+_LOG_LISTENER = None
+
+# Attributes every LogRecord has; anything else was passed via extra= and is
+# written as its own key in the JSON lines
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TracebackQueueHandler(logging.handlers.QueueHandler):
+    # QueueHandler.prepare folds the traceback into the message and clears
+    # exc_info/exc_text. Here the message stays plain and the traceback travels
+    # in exc_text: log.txt still prints it below the message, the JSON lines
+    # get it as a field of its own.
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+def setup_logging(log_dir, level, max_bytes=10*1024*1024, backup_count=10, json_lines=False):
+    # The event loop only puts records on a queue, a listener thread does the
+    # formatting and the file writes. Replaces handlers of a previous call,
+    # like basicConfig(force=True).
+    global _LOG_LISTENER
+    stop_logging()
+    os.makedirs(log_dir, exist_ok=True)
+
+    text_handler = logging.handlers.RotatingFileHandler(
+        os.path.join(log_dir, 'log.txt'), maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"
+    )
+    text_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    handlers = [text_handler]
+    if json_lines:
+        json_handler = logging.handlers.RotatingFileHandler(
+            os.path.join(log_dir, 'log.jsonl'), maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"
+        )
+        json_handler.setFormatter(JsonLinesFormatter())
+        handlers.append(json_handler)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    root.addHandler(TracebackQueueHandler(log_queue))
+    root.setLevel(level)
+
+    _LOG_LISTENER = logging.handlers.QueueListener(log_queue, *handlers)
+    _LOG_LISTENER.start()
+
+
+def stop_logging():
+    # Drains the queue and closes the files; registered with atexit
+    global _LOG_LISTENER
+    if _LOG_LISTENER is not None:
+        _LOG_LISTENER.stop()
+        for handler in _LOG_LISTENER.handlers:
+            handler.close()
+        _LOG_LISTENER = None
+
+
+atexit.register(stop_logging)
+
 # ---------------------------
 # MIME + JSON helpers
 # ---------------------------
@@ -96,45 +344,197 @@ def remove_timezone_offset(date_string):
         dt = datetime.fromisoformat(date_string)
         return dt.date().strftime('%Y-%m-%d')
     except ValueError as e:
-        logging.error(f"Error parsing date: {e}")
+        logging.error("Error parsing date: %s", e)
         return None
 
 
-def find_a_upload_file(searchFolder, fileToSearch):
-    if fileToSearch is None or not fileToSearch:
-        return '', 0
-    first_filename = None
-    count = 0
-
-    base_name, extension = os.path.splitext(fileToSearch)
-    if len(base_name) > 36:
-        base_name = base_name[:-36]
-
-    for filename in os.listdir(searchFolder):
-        if filename.startswith(base_name) and filename.endswith(extension):
-            if first_filename is None:
-                first_filename = filename
-            count += 1
+def get_peak_rss():
+    # Peak resident set size of this process in bytes, None if unknown
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    if os.name == "nt":
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [
+                ("cb", wintypes.DWORD),
+                ("PageFaultCount", wintypes.DWORD),
+                ("PeakWorkingSetSize", ctypes.c_size_t),
+                ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t),
+                ("PeakPagefileUsage", ctypes.c_size_t),
+            ]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        handle = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+    return None
 
-    return first_filename, count
 
 # ---------------------------
 # TOKEN-BASED AUTH (from your snippet)
 # ---------------------------
 CONFIG = {}
+RUN_STATS = {"small_uploads": 0, "requests_saved": 0, "duplicates_skipped": 0}
+
+
+class RunMetrics:
+    # Per-phase latency histograms and counters for one run. Histograms use
+    # fixed buckets, so a service that runs for weeks keeps constant memory.
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = datetime.now(timezone.utc)
+        self.phases = {}
+        self.counters = {}
+
+    def observe(self, phase, seconds):
+        with self._lock:
+            hist = self.phases.get(phase)
+            if hist is None:
+                hist = self.phases[phase] = {"count": 0, "sum": 0.0, "min": seconds, "max": seconds, "buckets": [0] * len(self.BUCKETS)}
+            hist["count"] += 1
+            hist["sum"] += seconds
+            hist["min"] = min(hist["min"], seconds)
+            hist["max"] = max(hist["max"], seconds)
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    hist["buckets"][i] += 1
+                    break
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def timer(self, phase):
+        return _PhaseTimer(self, phase)
+
+    def _quantile(self, hist, q):
+        # Linear interpolation inside the bucket that holds the q-th sample
+        rank = q * hist["count"]
+        seen = 0
+        lower = 0.0
+        for bound, n in zip(self.BUCKETS, hist["buckets"]):
+            if n and seen + n >= rank:
+                lower = max(lower, hist["min"])
+                upper = hist["max"] if bound == float("inf") else min(bound, hist["max"])
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+            lower = bound
+        return hist["max"]
+
+    def snapshot(self):
+        with self._lock:
+            phases = {}
+            for phase, hist in self.phases.items():
+                phases[phase] = {
+                    "count": hist["count"],
+                    "sum_seconds": round(hist["sum"], 6),
+                    "mean_seconds": round(hist["sum"] / hist["count"], 6),
+                    "min_seconds": round(hist["min"], 6),
+                    "max_seconds": round(hist["max"], 6),
+                    "p50_seconds": round(self._quantile(hist, 0.50), 6),
+                    "p95_seconds": round(self._quantile(hist, 0.95), 6),
+                    "p99_seconds": round(self._quantile(hist, 0.99), 6),
+                    "buckets": {("+Inf" if b == float("inf") else str(b)): n for b, n in zip(self.BUCKETS, hist["buckets"])},
+                }
+            counters = dict(self.counters)
+        counters.update(RUN_STATS)
+        finished = datetime.now(timezone.utc)
+        return {
+            "started": self.started.isoformat(),
+            "finished": finished.isoformat(),
+            "duration_seconds": round((finished - self.started).total_seconds(), 3),
+            "counters": counters,
+            "phases": phases,
+        }
 
-
-def ensure_token():
-    token_info = load_token()
-    if not token_info or is_token_expired(token_info):
-        return get_token()
-    return token_info
+    def write_json(self, path):
+        snapshot = self.snapshot()
+        peak_rss = get_peak_rss()
+        if peak_rss is not None:
+            snapshot["peak_rss_bytes"] = peak_rss
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f, indent=2)
+        os.replace(tmp_path, path)
+
+    def write_prometheus(self, path):
+        # node_exporter textfile format; written to a temp file and renamed so
+        # the collector never reads a half-written file
+        snapshot = self.snapshot()
+        lines = [
+            "# HELP xml2dw_phase_duration_seconds Duration of each processing phase",
+            "# TYPE xml2dw_phase_duration_seconds histogram",
+        ]
+        for phase, hist in sorted(snapshot["phases"].items()):
+            cumulative = 0
+            for bound, n in hist["buckets"].items():
+                cumulative += n
+                lines.append(f'xml2dw_phase_duration_seconds_bucket{{phase="{phase}",le="{bound}"}} {cumulative}')
+            lines.append(f'xml2dw_phase_duration_seconds_sum{{phase="{phase}"}} {hist["sum_seconds"]}')
+            lines.append(f'xml2dw_phase_duration_seconds_count{{phase="{phase}"}} {hist["count"]}')
+        lines.append("# HELP xml2dw_events_total Event counters of the current run")
+        lines.append("# TYPE xml2dw_events_total counter")
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f'xml2dw_events_total{{event="{name}"}} {value}')
+        lines.append("# HELP xml2dw_last_run_timestamp_seconds Time the metrics were written")
+        lines.append("# TYPE xml2dw_last_run_timestamp_seconds gauge")
+        lines.append(f"xml2dw_last_run_timestamp_seconds {time.time():.0f}")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+
+class _PhaseTimer:
+    def __init__(self, metrics, phase):
+        self.metrics = metrics
+        self.phase = phase
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.phase, time.perf_counter() - self.started)
+        if exc_type is not None:
+            self.metrics.count(f"{self.phase}_errors")
+        return False
+
+
+METRICS = RunMetrics()
+
+
+def write_run_metrics(metrics_path, prometheus_path=""):
+    try:
+        if metrics_path:
+            METRICS.write_json(metrics_path)
+        if prometheus_path:
+            METRICS.write_prometheus(prometheus_path)
+    except OSError as e:
+        logging.error("Metriken konnten nicht geschrieben werden: %s", str(e))
 
 
-def load_token():
+def load_token(settings=None):
+    # settings: the token part of one profile, CONFIG when not given
+    settings = CONFIG if settings is None else settings
     logging.debug("Loading token from file...")
-    token_file = CONFIG.get("token_file", "auth_token.json")
-    token_path = os.path.join(CONFIG.get("temp_path", r"C:\\DTW\\temp"), token_file)
+    token_file = settings.get("token_file", "auth_token.json")
+    token_path = os.path.join(settings.get("temp_path", r"C:\\DTW\\temp"), token_file)
     if os.path.exists(token_path):
         with open(token_path, "r") as f:
             logging.debug("Token file loaded successfully.")
@@ -142,19 +542,30 @@ def load_token():
     return None
 
 
-def is_token_expired(token_info):
+def save_token(token_info, settings=None):
+    settings = CONFIG if settings is None else settings
+    token_file = settings.get("token_file", "auth_token.json")
+    os.makedirs(settings.get("temp_path", r"C:\\DTW\\temp"), exist_ok=True)
+    with open(os.path.join(settings.get("temp_path", r"C:\\DTW\\temp"), token_file), "w") as f:
+        json.dump(token_info, f)
+
+
+def is_token_expired(token_info, margin=0):
     expires_at = datetime.fromisoformat(token_info["expires_at"])
-    return datetime.now() >= expires_at
+    return datetime.now() + timedelta(seconds=margin) >= expires_at
 
 
-def get_token():
+async def get_token(client, settings=None):
+    # Uses the shared AsyncClient, so verify/proxy settings and the pooled
+    # connection are the same as for the uploads
+    settings = CONFIG if settings is None else settings
     logging.info("Starting token retrieval...")
-    token_url = CONFIG["token_endpoint"]
+    token_url = settings["token_endpoint"]
     data = {
         "grant_type": "password",
         "client_id": "docuware.platform.net.client",
-        "username": CONFIG["username"],
-        "password": CONFIG["password"],
+        "username": settings["username"],
+        "password": settings["password"],
         "scope": "docuware.platform"
     }
     headers = {
@@ -163,16 +574,11 @@ def get_token():
     }
 
     try:
-        cert_file = CONFIG.get("cert_file")
-        verify_option = cert_file if cert_file else True
-        # Honor fiddler proxy if enabled
-        proxies = {
-            "http://": "http://localhost:8888",
-            "https://": "http://localhost:8888",
-        } if CONFIG.get("fiddler") else None
-
-        response = httpx.post(token_url, data=data, headers=headers, verify=verify_option, proxies=proxies, timeout=30)
-        logging.debug(f"Token endpoint responded with status {response.status_code}")
+        async def send():
+            with METRICS.timer("token"):
+                return await client.post(token_url, data=data, headers=headers, timeout=30)
+        response = await send_with_retry(send, token_url)
+        logging.debug("Token endpoint responded with status %s (%s)", response.status_code, response.http_version)
         if response.status_code == 200:
             token_data = response.json()
             access_token = token_data.get("access_token")
@@ -181,28 +587,543 @@ def get_token():
                 "access_token": access_token,
                 "expires_at": (datetime.now() + timedelta(seconds=expires_in)).isoformat()
             }
-            token_file = CONFIG.get("token_file", "auth_token.json")
-            os.makedirs(CONFIG.get("temp_path", r"C:\\DTW\\temp"), exist_ok=True)
-            with open(os.path.join(CONFIG.get("temp_path", r"C:\\DTW\\temp"), token_file), "w") as f:
-                json.dump(token_info, f)
+            await asyncio.to_thread(save_token, token_info, settings)
 
             logging.info("Token successfully obtained and saved.")
             return token_info
         else:
-            logging.error(f"Failed to obtain token: {response.status_code} - {response.text}")
+            logging.error("Failed to obtain token: %s - %s", response.status_code, response.text)
             return None
     except Exception as e:
-        logging.error(f"Error during token retrieval: {str(e)}")
+        logging.error("Error during token retrieval: %s", str(e))
         return None
 
+
+class TokenManager:
+    # Keeps the token in memory and renews it refresh_margin seconds before it
+    # expires. All coroutines share one refresh: whoever holds the lock fetches,
+    # everybody else waiting on it picks up the new token.
+
+    def __init__(self, client, refresh_margin=60, settings=None):
+        self.client = client
+        self.refresh_margin = refresh_margin
+        self.settings = settings
+        self._token_info = None
+        self._lock = asyncio.Lock()
+
+    def _usable(self, token_info):
+        return bool(token_info) and not is_token_expired(token_info, self.refresh_margin)
+
+    async def get(self):
+        token_info = self._token_info
+        if self._usable(token_info):
+            return token_info["access_token"]
+        async with self._lock:
+            if self._token_info is None:
+                # Only the first call of a run touches auth_token.json
+                self._token_info = await asyncio.to_thread(load_token, self.settings)
+            if not self._usable(self._token_info):
+                self._token_info = await get_token(self.client, self.settings)
+            return self._token_info["access_token"] if self._token_info else None
+
+    async def refresh(self, rejected_token):
+        # Called after a 401. If another coroutine already replaced the rejected
+        # token, that one is returned instead of fetching again.
+        async with self._lock:
+            current = self._token_info
+            if self._usable(current) and current["access_token"] != rejected_token:
+                return current["access_token"]
+            token_info = await get_token(self.client, self.settings)
+            if token_info:
+                self._token_info = token_info
+            return token_info["access_token"] if token_info else None
+
+
 # ---------------------------
 # Upload helpers (use Bearer token)
 # ---------------------------
 
-async def upload_big_file(document_data, new_file_path, chunk_size, client, data, url, base_url, access_token):
+class ChunkReader:
+    # Double-buffered chunk source for upload_big_file. While one chunk is on the
+    # wire a background thread reads the next one into the second buffer, so disk
+    # I/O overlaps network I/O and no new bytes object is allocated per chunk.
+    # Every view returned by read() stays valid until the following read().
+    # Changing chunk_size takes effect from the next read-ahead on. Reads and
+    # buffers never exceed what is left of the file, so a large chunk size
+    # does not cost memory on a small file.
+
+    def __init__(self, file, chunk_size, file_size=None):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.file_size = file_size
+        self._offset = 0
+        self._buffers = [bytearray(), bytearray()]
+        self._pending = None
+        self._pending_index = 0
+
+    def _next_size(self):
+        size = self.chunk_size
+        if self.file_size is not None:
+            size = max(0, min(size, self.file_size - self._offset))
+        self._offset += size
+        return size
+
+    def _readinto(self, index, size):
+        if len(self._buffers[index]) < size:
+            self._buffers[index] = bytearray(size)
+        view = memoryview(self._buffers[index])[:size]
+        filled = 0
+        while filled < len(view):
+            n = self.file.readinto(view[filled:])
+            if not n:
+                break
+            filled += n
+        return filled
+
+    async def read(self):
+        loop = asyncio.get_running_loop()
+        index = self._pending_index
+        if self._pending is None:
+            n = await loop.run_in_executor(None, self._readinto, index, self._next_size())
+        else:
+            n = await self._pending
+            self._pending = None
+        if n:
+            self._pending_index = index ^ 1
+            self._pending = loop.run_in_executor(None, self._readinto, self._pending_index, self._next_size())
+        return memoryview(self._buffers[index])[:n]
+
+    async def seek(self, offset):
+        await self.close()
+        self.file.seek(offset)
+        self._offset = offset
+
+    async def close(self):
+        if self._pending is not None:
+            try:
+                await self._pending
+            finally:
+                self._pending = None
+
+
+# Smoothed upload bandwidth over all uploads of this run, seeds new ChunkSizers
+CHUNK_SESSION = {"bandwidth": None}
+
+
+class ChunkSizer:
+    # Sizes chunks so each one takes about target_seconds on the wire, based on
+    # the measured per-chunk round trip. Sizes move by at most a factor of two
+    # per chunk and stay within [min_size, max_size].
+
+    def __init__(self, initial, min_size, max_size, target_seconds, adaptive=True):
+        self.adaptive = adaptive
+        self.min_size = max(1, min(min_size, max_size))
+        self.max_size = max(self.min_size, max_size)
+        self.target_seconds = target_seconds
+        self.bandwidth = None
+        if adaptive and CHUNK_SESSION["bandwidth"]:
+            initial = CHUNK_SESSION["bandwidth"] * target_seconds
+        self.size = self._clamp(initial) if adaptive else initial
+        self.chunks = 0
+        self.bytes_sent = 0
+        self.seconds = 0.0
+        self.smallest = None
+        self.largest = None
+
+    def _clamp(self, size):
+        return int(max(self.min_size, min(self.max_size, size)))
+
+    def record(self, size, seconds):
+        self.chunks += 1
+        self.bytes_sent += size
+        self.seconds += seconds
+        self.smallest = size if self.smallest is None else min(self.smallest, size)
+        self.largest = size if self.largest is None else max(self.largest, size)
+        if not self.adaptive or seconds <= 0:
+            return
+        sample = size / seconds
+        self.bandwidth = sample if self.bandwidth is None else 0.3 * sample + 0.7 * self.bandwidth
+        session = CHUNK_SESSION["bandwidth"]
+        CHUNK_SESSION["bandwidth"] = self.bandwidth if session is None else 0.2 * self.bandwidth + 0.8 * session
+        wanted = max(self.size / 2, min(self.size * 2, self.bandwidth * self.target_seconds))
+        self.size = self._clamp(wanted)
+        logging.debug("Chunk %d Bytes in %.3fs (%.2f MB/s) - naechste Chunkgroesse %d Bytes", size, seconds, sample / (1024 * 1024), self.size)
+
+    def log_summary(self, file_name):
+        if not self.chunks:
+            return
+        logging.info(
+            "DATEI: %s - %d Chunks, Chunkgroesse %.1f-%.1f KiB, %.2f MB/s",
+            file_name, self.chunks, self.smallest / 1024, self.largest / 1024,
+            self.bytes_sent / (1024 * 1024) / max(self.seconds, 1e-6)
+        )
+
+
+# Per-document journal in temp_path so an interrupted chunked upload can
+# continue from the last acknowledged chunk instead of byte 0
+def upload_journal_path(new_file_path, temp_path=None):
+    # Keyed by the full path, two cabinets may receive files of the same name.
+    # temp_path is the profile's, CONFIG's when not given.
+    key = hashlib.sha1(os.path.normcase(os.path.abspath(new_file_path)).encode("utf-8")).hexdigest()
+    temp_path = temp_path or CONFIG.get("temp_path", r"C:\\DTW\\temp")
+    return os.path.join(temp_path, "upload_journal", key + ".json")
+
+
+def file_fingerprint(path, sample=64*1024):
+    # Size plus head and tail of the file, cheap even for multi-hundred-MB scans
+    size = os.path.getsize(path)
+    digest = hashlib.sha1(str(size).encode("ascii"))
+    with open(path, 'rb') as f:
+        digest.update(f.read(sample))
+        if size > sample:
+            f.seek(max(sample, size - sample))
+            digest.update(f.read(sample))
+    return digest.hexdigest()
+
+
+def hash_file(path, hasher=None, length=None, block=1024*1024):
+    # SHA-256 over the whole file or its first `length` bytes
+    hasher = hasher or hashlib.sha256()
+    remaining = length
+    with open(path, 'rb') as f:
+        while remaining is None or remaining > 0:
+            data = f.read(block if remaining is None else min(block, remaining))
+            if not data:
+                break
+            hasher.update(data)
+            if remaining is not None:
+                remaining -= len(data)
+    return hasher
+
+
+def load_upload_journal(new_file_path, fingerprint, temp_path=None):
+    journal_path = upload_journal_path(new_file_path, temp_path)
+    if not os.path.exists(journal_path):
+        return None
+    try:
+        with open(journal_path, "r") as f:
+            journal = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning("Upload-Journal %s nicht lesbar: %s", journal_path, str(e))
+        return None
+    if journal.get("fingerprint") != fingerprint:
+        logging.info("DATEI: %s - Datei hat sich seit dem letzten Versuch geaendert, Upload startet neu", os.path.basename(new_file_path))
+        remove_upload_journal(new_file_path, temp_path)
+        return None
+    return journal
+
+
+def save_upload_journal(new_file_path, journal, temp_path=None):
+    journal_path = upload_journal_path(new_file_path, temp_path)
+    os.makedirs(os.path.dirname(journal_path), exist_ok=True)
+    tmp_path = journal_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(journal, f)
+    os.replace(tmp_path, journal_path)
+
+
+def remove_upload_journal(new_file_path, temp_path=None):
+    try:
+        os.remove(upload_journal_path(new_file_path, temp_path))
+    except FileNotFoundError:
+        pass
+
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+# Statuses that say the server turned the request away without processing it;
+# only these are retried for requests that would create a second document
+REJECTED_STATUS = {429, 503}
+
+# Transport errors raised before the request left the client; only these are
+# safe to retry for requests that would create a second document
+UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    # Shared by every request of a run. After failure_threshold consecutive
+    # transient failures (5xx, 429, timeouts, resets) the circuit opens and
+    # all callers wait instead of hammering the server. When the cool-down is
+    # over a single probe request goes through: success closes the circuit,
+    # failure reopens it with a doubled cool-down. Once the server has been
+    # degraded for give_up_seconds, callers fail fast with CircuitOpenError
+    # and their documents are retried later; the probes go on every
+    # max_reset_seconds at most, so the circuit still closes once the server
+    # is back.
+
+    def __init__(self, failure_threshold=10, reset_seconds=30, max_reset_seconds=300, give_up_seconds=600, name=""):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_seconds = reset_seconds
+        self.max_reset_seconds = max(reset_seconds, max_reset_seconds)
+        self.give_up_seconds = give_up_seconds
+        self.failures = 0
+        self.cooldown = reset_seconds
+        self.open_until = None
+        self.degraded_since = None
+        self.probing = False
+
+    @property
+    def is_open(self):
+        return self.open_until is not None
+
+    async def acquire(self):
+        while self.open_until is not None:
+            now = time.monotonic()
+            if now >= self.open_until and not self.probing:
+                # Also after give-up, otherwise the circuit could never close
+                self.probing = True
+                return
+            if self.give_up_seconds and now - self.degraded_since >= self.give_up_seconds:
+                raise CircuitOpenError(f"Server {self.name} seit {now - self.degraded_since:.0f}s nicht erreichbar, Circuit Breaker offen")
+            if now < self.open_until:
+                await asyncio.sleep(self.open_until - now)
+            else:
+                await asyncio.sleep(min(1.0, self.reset_seconds))
+
+    def record_success(self):
+        self.failures = 0
+        if self.open_until is not None:
+            logging.info("Circuit Breaker %s geschlossen, Server antwortet wieder", self.name)
+            METRICS.count("circuit_closed")
+        self.open_until = None
+        self.degraded_since = None
+        self.cooldown = self.reset_seconds
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        now = time.monotonic()
+        if self.probing:
+            self.probing = False
+            self.cooldown = min(self.cooldown * 2, self.max_reset_seconds)
+            self.open_until = now + self.cooldown
+            logging.warning("Circuit Breaker %s: Testanfrage fehlgeschlagen, naechster Versuch in %.1fs", self.name, self.cooldown)
+        elif self.open_until is None and self.failures >= self.failure_threshold:
+            self.open_until = now + self.cooldown
+            self.degraded_since = now
+            METRICS.count("circuit_opened")
+            logging.warning("Circuit Breaker %s offen nach %d Fehlern in Folge, Pause %.1fs", self.name, self.failures, self.cooldown)
+
+
+# One breaker per host, so a degraded server only pauses the profiles using it
+CIRCUIT_SETTINGS = {}
+CIRCUITS = {}
+
+
+def circuit_for(target):
+    host = urllib.parse.urlsplit(target).netloc
+    breaker = CIRCUITS.get(host)
+    if breaker is None:
+        breaker = CIRCUITS[host] = CircuitBreaker(**CIRCUIT_SETTINGS, name=host)
+    return breaker
+
+
+def retry_after_seconds(response):
+    # Retry-After is either delta-seconds or an HTTP date
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def backoff_delay(attempt):
+    # Exponential backoff with full jitter, so parallel workers that failed
+    # together do not come back in lockstep
+    delay = min(CONFIG.get("retry_backoff", 1.0) * 2 ** attempt, CONFIG.get("retry_backoff_max", 30))
+    return random.uniform(0, delay) if CONFIG.get("retry_jitter", True) else delay
+
+
+async def send_with_retry(send, target, idempotent=True):
+    # Runs send() (a coroutine function issuing one request) under the retry
+    # policy and the circuit breaker. The last response, or transport error,
+    # is handed back to the caller unchanged.
+    retries = CONFIG.get("chunk_retries", 3)
+    circuit = circuit_for(target)
+    for attempt in range(retries + 1):
+        await circuit.acquire()
+        try:
+            response = await send()
+        except httpx.TransportError as e:
+            circuit.record_failure()
+            if attempt == retries or not (idempotent or isinstance(e, UNSENT_ERRORS)):
+                raise
+            reason = str(e) or type(e).__name__
+            delay = backoff_delay(attempt)
+        else:
+            if response.status_code not in RETRYABLE_STATUS:
+                circuit.record_success()
+                return response
+            circuit.record_failure()
+            if attempt == retries or not (idempotent or response.status_code in REJECTED_STATUS):
+                # A 500/502/504 may come after the document was created
+                return response
+            reason = response.status_code
+            delay = retry_after_seconds(response)
+            if delay is None:
+                delay = backoff_delay(attempt)
+            delay = min(delay, CONFIG.get("retry_after_max", 120))
+        METRICS.count("http_retries")
+        logging.warning("Anfrage an %s fehlgeschlagen (%s) - Versuch %d/%d in %.1fs", target, reason, attempt + 1, retries, delay)
+        await asyncio.sleep(delay)
+
+
+class BandwidthLimiter:
+    # Token bucket on the bytes sent by chunk and multipart uploads, shared by
+    # all profiles. The rate follows the configured time windows, 0 means
+    # unlimited. A caller takes its bytes on credit and sleeps off the debt
+    # while holding the lock, so waiters are served in turn and the send rate
+    # stays at the cap instead of bursting.
+
+    def __init__(self, rate=0, windows=(), burst=256*1024, inflight_seconds=5):
+        self.rate_default = rate
+        self.windows = [self._parse_window(window) for window in windows]
+        self.burst = max(1, burst)
+        self.inflight_seconds = inflight_seconds
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+        self._last_rate = None
+
+    @staticmethod
+    def _parse_window(window):
+        # {"days": [1, 2, 3, 4, 5], "from": "07:00", "to": "18:00", "limit_mb_per_s": 2}
+        # days are ISO weekdays (1 = Montag), all days when missing. A window
+        # whose "to" is before "from" runs over midnight.
+        days = set(window.get("days") or range(1, 8))
+        if not days <= set(range(1, 8)):
+            raise ValueError(f"Ungueltige Wochentage im Zeitfenster: {window.get('days')}")
+        start = datetime.strptime(window.get("from", "00:00"), "%H:%M").time()
+        end = datetime.strptime(window.get("to", "00:00"), "%H:%M").time()
+        return days, start, end, int(window.get("limit_mb_per_s", 0) * 1024 * 1024)
+
+    def rate(self, now=None):
+        now = now or datetime.now()
+        current = now.time()
+        rate = self.rate_default
+        for days, start, end, window_rate in self.windows:
+            if start < end:
+                inside = now.isoweekday() in days and start <= current < end
+            else:
+                # Over midnight the part after 00:00 belongs to the previous day
+                day = now.isoweekday() if current >= start else (now - timedelta(days=1)).isoweekday()
+                inside = day in days and (current >= start or current < end)
+            if inside:
+                rate = window_rate
+                break
+        if rate != self._last_rate:
+            if rate:
+                logging.info("Bandbreitenlimit: %.2f MB/s", rate / (1024 * 1024))
+            elif self._last_rate is not None:
+                logging.info("Bandbreitenlimit aufgehoben")
+            self._last_rate = rate
+        return rate
+
+    def inflight_cap(self):
+        # Bytes the limiter lets through in inflight_seconds, 0 when unlimited
+        rate = self.rate()
+        return int(rate * self.inflight_seconds) if rate else 0
+
+    async def consume(self, size):
+        rate = self.rate()
+        if not rate or size <= 0:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * rate)
+            self._updated = now
+            self._tokens -= size
+            if self._tokens < 0:
+                wait = -self._tokens / rate
+                METRICS.observe("throttle", wait)
+                await asyncio.sleep(wait)
+
+
+BANDWIDTH = BandwidthLimiter()
+
+
+async def stream_view(view, piece=256*1024):
+    # Feeds a memoryview to httpx without copying it into a new bytes object.
+    # Every piece passes the bandwidth limiter right before it is sent.
+    for start in range(0, len(view), piece):
+        block = view[start:start + piece]
+        await BANDWIDTH.consume(len(block))
+        yield block
+
+
+async def post_chunk(client, chunk_url, body, headers, url):
+    # `body` is a memoryview from ChunkReader, a fresh stream is built for
+    # every attempt. The first chunk goes to the collection `url` and creates
+    # the document, so it is not retried once it may have reached the server.
+    async def send():
+        with METRICS.timer("chunk_post"):
+            return await client.post(chunk_url, content=stream_view(body), headers=headers)
+    return await send_with_retry(send, chunk_url, idempotent=(chunk_url != url))
+
+
+async def index_document(document_data, client, data, url, doc_id, access_token):
+    # document_data is the pre-rendered JSON array of index fields
+    indexing_url = url+f'/{doc_id}/Fields'
+    idx_headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Accept": "application/json",
+        "Content-Type": "application/json"
+    }
+    async def send():
+        with METRICS.timer("fields_put"):
+            return await client.put(indexing_url, content=field_envelope("Field", document_data), headers=idx_headers)
+    indexing = await send_with_retry(send, indexing_url)
+    return {
+        "data": data,
+        "status_code": indexing.status_code,
+        "text": indexing.text
+    }
+
+
+async def upload_big_file(document_data, new_file_path, chunk_size, client, data, url, base_url, token_manager, defer_index=False, temp_path=None):
     return_data = {}
+    access_token = await token_manager.get()
     file_size = os.path.getsize(new_file_path)
     chunk_url = url
+    offset = 0
+
+    # Journal and fingerprint touch the disk, like the chunk reads they stay
+    # off the event loop
+    fingerprint = await asyncio.to_thread(file_fingerprint, new_file_path)
+    journal = await asyncio.to_thread(load_upload_journal, new_file_path, fingerprint, temp_path)
+    if journal and journal.get("doc_id"):
+        # Every chunk was acknowledged in an earlier run, only the indexing is missing
+        logging.info("DATEI: %s - Dokument %s bereits hochgeladen, nur Indexierung wird wiederholt", data["FileName"], journal["doc_id"])
+        return_data = await index_document(document_data, client, data, url, journal["doc_id"], access_token)
+        if return_data["status_code"] == 200:
+            await asyncio.to_thread(remove_upload_journal, new_file_path, temp_path)
+            return_data["doc_id"] = journal["doc_id"]
+            return_data["content_hash"] = (await asyncio.to_thread(hash_file, new_file_path)).hexdigest()
+        return return_data
+    resumed = journal is not None
+    if resumed:
+        chunk_url = journal["next_url"]
+        offset = journal["offset"]
+        logging.info("DATEI: %s - Upload wird bei Byte %d von %d fortgesetzt", data["FileName"], offset, file_size)
+
+    # Content hash for the dedup store, fed with every acknowledged chunk
+    hasher = hashlib.sha256()
+    if offset:
+        await asyncio.to_thread(hash_file, new_file_path, hasher, offset)
 
     headers = {
         "Authorization": f"Bearer {access_token}",
@@ -214,146 +1135,366 @@ async def upload_big_file(document_data, new_file_path, chunk_size, client, data
         "X-File-Size": str(file_size)
     }
 
-    with open(new_file_path, 'rb') as file:
-        chunk = file.read(chunk_size)
-        offset = 0
-
-        while chunk:
-            body = chunk
-            headers["Content-Length"] = str(len(body))
+    sizer = ChunkSizer(
+        chunk_size,
+        CONFIG.get("chunk_size_min", chunk_size),
+        CONFIG.get("chunk_size_max", chunk_size),
+        CONFIG.get("chunk_target_seconds", 2.0),
+        adaptive=CONFIG.get("adaptive_chunks", False),
+    )
 
-            response = await client.post(chunk_url, content=body, headers=headers)
+    with open(new_file_path, 'rb', buffering=0) as file:
+        reader = ChunkReader(file, sizer.size, file_size)
+        try:
+            await reader.seek(offset)
+            chunk = await reader.read()
 
-            if response.status_code == 401:
-                # refresh token once
-                token_info = ensure_token()
-                if not token_info:
-                    return {"data": data, "status_code": 401, "text": "Unauthorized and token refresh failed"}
-                access_token = token_info["access_token"]
+            while chunk:
+                headers["Content-Length"] = str(len(chunk))
+                access_token = await token_manager.get()
                 headers["Authorization"] = f"Bearer {access_token}"
-                response = await client.post(chunk_url, content=body, headers=headers)
 
-            if response.status_code == 200:
-                try:
-                    xml_response = xmltodict.parse(response.text)
-                    path = xml_response['Document']['FileChunk']['s:Links']['s:Link']['@href']
-                    chunk_url = base_url + path
-                    offset += len(chunk)
-                    chunk = file.read(chunk_size)
-                except Exception:
-                    return_data = {
-                        "data": data,
-                        "status_code": response.status_code,
-                        "text": response.text
-                    }
+                started = time.monotonic()
+                response = await post_chunk(client, chunk_url, chunk, headers, url)
+
+                if response.status_code == 401:
+                    # refresh token once
+                    access_token = await token_manager.refresh(access_token)
+                    if not access_token:
+                        return {"data": data, "status_code": 401, "text": "Unauthorized and token refresh failed"}
+                    headers["Authorization"] = f"Bearer {access_token}"
+                    response = await post_chunk(client, chunk_url, chunk, headers, url)
+
+                if resumed and response.status_code in (404, 410):
+                    # The server dropped the partial upload, start over from byte 0
+                    logging.warning("DATEI: %s - Teil-Upload auf dem Server nicht mehr vorhanden, Upload startet neu", data["FileName"])
+                    await asyncio.to_thread(remove_upload_journal, new_file_path, temp_path)
+                    resumed = False
+                    chunk_url = url
+                    offset = 0
+                    hasher = hashlib.sha256()
+                    await reader.seek(0)
+                    chunk = await reader.read()
+                    continue
+                resumed = False
+
+                if response.status_code == 200:
+                    hasher.update(chunk)
+                    sizer.record(len(chunk), time.monotonic() - started)
+                    reader.chunk_size = sizer.size
                     try:
-                        nsmap = {
-                            'd': 'http://dev.docuware.com/schema/public/services/platform',
-                            's': 'http://dev.docuware.com/schema/public/services'
-                        }
-                        xml_data = etree.fromstring(response.content)
-                        doc_id = xml_data.xpath("//d:Field[@FieldName='DWDOCID']/d:Int/text()", namespaces=nsmap)
-                        indexing_url = url+f'/{doc_id[0]}/Fields'
-                        idx_headers = {
-                            "Authorization": f"Bearer {access_token}",
-                            "Accept": "application/json",
-                            "Content-Type": "application/json"
-                        }
-                        indexing = await client.put(indexing_url, json=document_data, headers=idx_headers)
-                        return_data = {
-                            "data": data,
-                            "status_code": indexing.status_code,
-                            "text": indexing.text
-                        }
-                    except Exception as e:
+                        xml_response = xmltodict.parse(response.text)
+                        path = xml_response['Document']['FileChunk']['s:Links']['s:Link']['@href']
+                        chunk_url = base_url + path
+                        offset += len(chunk)
+                        await asyncio.to_thread(save_upload_journal, new_file_path, {
+                            "file": data["FileName"],
+                            "fingerprint": fingerprint,
+                            "size": file_size,
+                            "next_url": chunk_url,
+                            "offset": offset,
+                        }, temp_path)
+                        chunk = await reader.read()
+                    except Exception:
+                        sizer.log_summary(data["FileName"])
                         return_data = {
                             "data": data,
                             "status_code": response.status_code,
                             "text": response.text
                         }
+                        try:
+                            nsmap = {
+                                'd': 'http://dev.docuware.com/schema/public/services/platform',
+                                's': 'http://dev.docuware.com/schema/public/services'
+                            }
+                            xml_data = etree.fromstring(response.content)
+                            doc_id = xml_data.xpath("//d:Field[@FieldName='DWDOCID']/d:Int/text()", namespaces=nsmap)
+                            await asyncio.to_thread(save_upload_journal, new_file_path, {
+                                "file": data["FileName"],
+                                "fingerprint": fingerprint,
+                                "size": file_size,
+                                "doc_id": doc_id[0],
+                            }, temp_path)
+                            if defer_index:
+                                # The Fields PUT runs in the IndexingStage, the upload slot is free now
+                                return {
+                                    "data": data,
+                                    "status_code": "Uploaded",
+                                    "text": response.text,
+                                    "doc_id": doc_id[0],
+                                    "content_hash": hasher.hexdigest(),
+                                    "index_pending": True,
+                                    "index_data": document_data,
+                                    "file_path": new_file_path,
+                                    "temp_path": temp_path,
+                                }
+                            return_data = await index_document(document_data, client, data, url, doc_id[0], access_token)
+                            if return_data["status_code"] == 200:
+                                await asyncio.to_thread(remove_upload_journal, new_file_path, temp_path)
+                                return_data["doc_id"] = doc_id[0]
+                                return_data["content_hash"] = hasher.hexdigest()
+                        except Exception as e:
+                            return_data = {
+                                "data": data,
+                                "status_code": response.status_code,
+                                "text": response.text
+                            }
+                        return return_data
+                else:
+                    return_data = {
+                        "data": data,
+                        "status_code": response.status_code,
+                        "text": response.text
+                    }
                     return return_data
-            else:
-                return_data = {
-                    "data": data,
-                    "status_code": response.status_code,
-                    "text": response.text
-                }
-                return return_data
 
-        return_data = {
-            "data": data,
-            "status_code": "Error",
-            "text": "Chunking completed without the last chunk"
-        }
+            return_data = {
+                "data": data,
+                "status_code": "Error",
+                "text": "Chunking completed without the last chunk"
+            }
+        finally:
+            await reader.close()
     return return_data
 
 
-async def upload_small_file(document_data, new_file_path, client, data, url, access_token):
+def upload_buffer_bytes(file_size, chunk_size):
+    # Memory one upload holds: the whole file for a multipart upload, the two
+    # ChunkReader buffers for a chunked one, each at most the largest chunk
+    # and never more than the file
+    if file_size <= CONFIG.get("small_file_threshold", 0):
+        return file_size
+    largest = max(chunk_size, CONFIG.get("chunk_size_max", chunk_size)) if CONFIG.get("adaptive_chunks") else chunk_size
+    return 2 * min(largest, file_size)
+
+
+def read_file_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+async def upload_small_file(document_data, new_file_path, client, data, url, token_manager):
+    # One multipart request carrying the index data and the file. httpx sets the
+    # multipart Content-Type itself, an explicit one would lack the boundary.
+    access_token = await token_manager.get()
     headers = {
         "Authorization": f"Bearer {access_token}",
-        "Content-Type": "multipart/form-data",
+        "Accept": "application/json",
         "X-File-ModifiedDate": data.get("Created", "")
     }
     mime_type = get_mime_type(new_file_path)
-    with open(new_file_path, 'rb') as new_file:
-        files = {
-            'document': ('', json.dumps(document_data), 'application/json'),
-            'file[]': (data["FileName"], new_file, mime_type)
+    content = await asyncio.to_thread(read_file_bytes, new_file_path)
+    # The document part is a Document object, which names its list "Fields"
+    files = {
+        'document': ('', field_envelope("Fields", document_data), 'application/json'),
+        'file[]': (data["FileName"], content, mime_type)
+    }
+    async def send():
+        # The whole request is small, so it passes the limiter in one go
+        await BANDWIDTH.consume(len(content))
+        with METRICS.timer("multipart_post"):
+            return await client.post(url, headers=headers, files=files)
+    # A request that reached the server may already have created the document
+    response = await send_with_retry(send, url, idempotent=False)
+    if response.status_code == 401:
+        # refresh token once
+        access_token = await token_manager.refresh(access_token)
+        if not access_token:
+            return {"data": data, "status_code": 401, "text": "Unauthorized and token refresh failed"}
+        headers["Authorization"] = f"Bearer {access_token}"
+        response = await send_with_retry(send, url, idempotent=False)
+    if response.status_code == 200:
+        try:
+            doc_id = response.json().get("Id")
+        except ValueError:
+            doc_id = None
+        return {
+            "data": data,
+            "status_code": response.status_code,
+            "text": response.text,
+            "doc_id": doc_id,
+            "content_hash": hashlib.sha256(content).hexdigest()
         }
-        response = await client.post(url, headers=headers, files=files)
-        if response.status_code == 200:
-            return {
-                "data": data,
-                "status_code": response.status_code,
-                "text": response.text
-            }
-        else:
-            return {
-                "data": data,
-                "status_code": response.status_code,
-                "text": "Failed to upload file"
-            }
+    else:
+        return {
+            "data": data,
+            "status_code": response.status_code,
+            "text": "Failed to upload file"
+        }
+
+
+# ---------------------------
+# Index field mapping (compiled once from config.json)
+# ---------------------------
+
+# The index fields as they were hard-coded before the mapping became
+# configurable. "source" names a key of the parsed `data` dict (a list is a
+# fallback chain, the first non-empty value wins), "xpath" is evaluated on
+# the XML itself, "constant" is a fixed value. "fallback" lists further
+# {"source"|"xpath"|"constant": ...} candidates, tried in order when the
+# field's own value is empty. Fields that stay empty are skipped.
+DEFAULT_FIELD_MAPPING = [
+    {"field": "UNTERBELEGART", "source": "DokumentTyp", "type": "String", "convert": "upper"},
+    {"field": "BELEGDATUM", "source": "Belegdatum", "type": "Date"},
+    {"field": "KST_KTR_BEZEICHNUNG", "source": "Projektnummer", "type": "String"},
+    {"field": "KST", "source": "Projektnummer", "type": "Decimal", "convert": "int"},
+    {"field": "KU__LIEF_NAME", "source": ["LiefName", "KundeName"], "type": "String"},
+    {"field": "KU__LIEF_NR_", "source": ["LiefNr", "KundeNr"], "type": "Decimal", "convert": "int"},
+    {"field": "DATEINAME", "source": "FileName", "type": "String"},
+    {"field": "KOMMISION_KURZBESCHREIBUNG", "source": "Bemerkung", "type": "String"},
+    {"field": "MANDANT", "source": "Mandant", "type": "String"},
+    {"field": "BELEGNUMMER", "source": "Belegnummer", "type": "String"},
+    {"field": "VERSANDART", "constant": "AUSGANGSPOST-PDS", "type": "String"},
+    {"field": "KFM__STATUS1", "constant": ".", "type": "String"},
+    {"field": "KFM__STATUS2", "constant": ".", "type": "String"},
+    {"field": "KFM__STATUS3", "constant": ".", "type": "String"},
+    {"field": "KFM__STATUS4", "constant": ".", "type": "String"},
+    {"field": "KFM__STATUS5", "constant": ".", "type": "String"},
+    {"field": "KFM__STATUS6", "constant": ".", "type": "String"},
+    {"field": "KFM__STATUS7", "constant": ".", "type": "String"},
+    {"field": "KFM__STATUS8", "constant": ".", "type": "String"},
+    {"field": "VERSIONSSTATUS", "constant": ".", "type": "String"},
+    {"field": "TECHN__STATUS", "constant": ".", "type": "String"},
+    {"field": "CREATED", "source": "Created", "type": "DateTime"},
+    {"field": "BETRAG", "source": "Betrag", "type": "Decimal", "convert": "float"},
+]
+
+FIELD_TYPES = {"String", "Int", "Decimal", "Date", "DateTime"}
+
+FIELD_CONVERTERS = {
+    None: None,
+    "int": int,
+    "float": float,
+    "upper": lambda value: str(value).upper(),
+    "lower": lambda value: str(value).lower(),
+    "str": str,
+}
+
+
+class FieldMapping:
+    # Compiles the mapping once: constant fields become ready JSON fragments,
+    # the others a (sources, converter, JSON prefix) step, so rendering a
+    # document is a few dict lookups and one json.dumps per value.
+
+    def __init__(self, entries):
+        self.steps = []
+        self.xpaths = []
+        for number, entry in enumerate(entries, 1):
+            name = entry.get("field")
+            field_type = entry.get("type", "String")
+            if not name:
+                raise ValueError(f"Feldzuordnung {number}: 'field' fehlt")
+            if field_type not in FIELD_TYPES:
+                raise ValueError(f"Feldzuordnung {name}: unbekannter Typ {field_type!r}")
+            if entry.get("convert") not in FIELD_CONVERTERS:
+                raise ValueError(f"Feldzuordnung {name}: unbekannte Umwandlung {entry.get('convert')!r}")
+            fallback = entry.get("fallback", [])
+            if not isinstance(fallback, list):
+                raise ValueError(f"Feldzuordnung {name}: 'fallback' muss eine Liste sein")
+            convert = FIELD_CONVERTERS[entry.get("convert")]
+            prefix = '{"FieldName": %s, "Item": ' % json.dumps(name)
+            suffix = ', "ItemElementName": %s}' % json.dumps(field_type)
+            sources = self._sources(name, entry)
+            if "constant" in entry and not fallback:
+                value = entry["constant"] if convert is None else convert(entry["constant"])
+                self.steps.append(prefix + json.dumps(value) + suffix)
+                continue
+            for candidate in fallback:
+                sources += self._sources(name, candidate)
+            self.steps.append((sources, convert, prefix, suffix))
+        self.xpaths = tuple(dict.fromkeys(self.xpaths))
+
+    def _sources(self, name, entry):
+        # (kind, key) candidates of one mapping entry or fallback item
+        if not isinstance(entry, dict):
+            raise ValueError(f"Feldzuordnung {name}: ungueltiger Eintrag {entry!r}")
+        kinds = [key for key in ("source", "xpath", "constant") if key in entry]
+        if len(kinds) != 1:
+            raise ValueError(f"Feldzuordnung {name}: genau eins von 'source', 'xpath' oder 'constant' angeben")
+        if "constant" in entry:
+            return (("constant", entry["constant"]),)
+        if "xpath" in entry:
+            etree.XPath(entry["xpath"])
+            self.xpaths.append(entry["xpath"])
+            return (("xpath", entry["xpath"]),)
+        names = entry["source"] if isinstance(entry["source"], list) else [entry["source"]]
+        return tuple(("data", source) for source in names)
+
+    def render(self, data):
+        # JSON array text of the index fields for one document
+        parts = []
+        xpath_values = data.get("xpath", {})
+        for step in self.steps:
+            if isinstance(step, str):
+                parts.append(step)
+                continue
+            sources, convert, prefix, suffix = step
+            for kind, key in sources:
+                if kind == "data":
+                    value = data.get(key)
+                elif kind == "xpath":
+                    value = xpath_values.get(key)
+                else:
+                    value = key
+                if value:
+                    break
+            else:
+                continue
+            if convert is not None:
+                value = convert(value)
+            parts.append(prefix + json.dumps(value) + suffix)
+        return "[" + ", ".join(parts) + "]"
+
+
+def field_envelope(key, fields_json):
+    # {"Field": [...]} for the Fields PUT, {"Fields": [...]} for a Document
+    return '{"%s": %s}' % (key, fields_json)
+
 
+FIELD_MAPPING = FieldMapping(DEFAULT_FIELD_MAPPING)
 
-async def upload_with_restapi(base_url, data, xml_path, client, url, chunk_size, access_token):
+
+async def upload_with_restapi(base_url, data, xml_path, client, url, chunk_size, token_manager, dedup=None, mapping=None, defer_index=False, temp_path=None):
     new_file_path = os.path.join(xml_path, data["FileName"]) 
 
-    document_data = {"Field": []}
-    if data["DokumentTyp"]: document_data["Field"].append({"FieldName": "UNTERBELEGART", "Item": data["DokumentTyp"].upper(), "ItemElementName": "String"})
-    if data["Belegdatum"]: document_data["Field"].append({"FieldName": "BELEGDATUM", "Item": data["Belegdatum"], "ItemElementName": "Date"})
-    if data["Projektnummer"]:
-        document_data["Field"].append({"FieldName": "KST_KTR_BEZEICHNUNG", "Item": data["Projektnummer"], "ItemElementName": "String"})
-        document_data["Field"].append({"FieldName": "KST", "Item": int(data["Projektnummer"]), "ItemElementName": "Decimal"})
-    if data["LiefName"]:
-        document_data["Field"].append({"FieldName": "KU__LIEF_NAME", "Item": data["LiefName"], "ItemElementName": "String"})
-    elif data["KundeName"]:
-        document_data["Field"].append({"FieldName": "KU__LIEF_NAME", "Item": data["KundeName"], "ItemElementName": "String"})
-    if data["LiefNr"]:
-        document_data["Field"].append({"FieldName": "KU__LIEF_NR_", "Item": int(data["LiefNr"]), "ItemElementName": "Decimal"})
-    elif data["KundeNr"]:
-        document_data["Field"].append({"FieldName": "KU__LIEF_NR_", "Item": int(data["KundeNr"]), "ItemElementName": "Decimal"})
-    if data["FileName"]: document_data["Field"].append({"FieldName": "DATEINAME", "Item": data["FileName"], "ItemElementName": "String"})
-    if data["Bemerkung"]: document_data["Field"].append({"FieldName": "KOMMISION_KURZBESCHREIBUNG", "Item": data["Bemerkung"], "ItemElementName": "String"})
-    if data["Mandant"]: document_data["Field"].append({"FieldName": "MANDANT", "Item": data["Mandant"], "ItemElementName": "String"})
-    if data["Belegnummer"]: document_data["Field"].append({"FieldName": "BELEGNUMMER", "Item": data["Belegnummer"], "ItemElementName": "String"})
-    document_data["Field"].append({"FieldName": "VERSANDART", "Item": "AUSGANGSPOST-PDS", "ItemElementName": "String"})
-    document_data["Field"].append({"FieldName": "KFM__STATUS1", "Item": ".", "ItemElementName": "String"})
-    document_data["Field"].append({"FieldName": "KFM__STATUS2", "Item": ".", "ItemElementName": "String"})
-    document_data["Field"].append({"FieldName": "KFM__STATUS3", "Item": ".", "ItemElementName": "String"})
-    document_data["Field"].append({"FieldName": "KFM__STATUS4", "Item": ".", "ItemElementName": "String"})
-    document_data["Field"].append({"FieldName": "KFM__STATUS5", "Item": ".", "ItemElementName": "String"})
-    document_data["Field"].append({"FieldName": "KFM__STATUS6", "Item": ".", "ItemElementName": "String"})
-    document_data["Field"].append({"FieldName": "KFM__STATUS7", "Item": ".", "ItemElementName": "String"})
-    document_data["Field"].append({"FieldName": "KFM__STATUS8", "Item": ".", "ItemElementName": "String"})
-    document_data["Field"].append({"FieldName": "VERSIONSSTATUS", "Item": ".", "ItemElementName": "String"})
-    document_data["Field"].append({"FieldName": "TECHN__STATUS", "Item": ".", "ItemElementName": "String"})
-    if data["Created"]: document_data["Field"].append({"FieldName": "CREATED", "Item": data["Created"], "ItemElementName": "DateTime"})
-    if data["Betrag"]: document_data["Field"].append({"FieldName": "BETRAG", "Item": float(data["Betrag"]), "ItemElementName": "Decimal"})
-
-    logging.debug("Data to push to the server for file %s: \n%s", data["OriginalFileName"],json.dumps(document_data))
+    document_data = (mapping or FIELD_MAPPING).render(data)
+
+    logging.debug("Data to push to the server for file %s: \n%s", data["OriginalFileName"], document_data)
 
     if os.path.isfile(new_file_path):
-        return await upload_big_file(document_data, new_file_path, chunk_size, client, data, url, base_url, access_token)
+        dedup_key = data.get("DokumentID") if dedup is not None else None
+        if dedup_key and dedup.has(dedup_key):
+            # Only documents already seen under this DokumentID are hashed up front
+            content_hash = (await asyncio.to_thread(hash_file, new_file_path)).hexdigest()
+            known = dedup.lookup(dedup_key, content_hash)
+            if known is not None:
+                RUN_STATS["duplicates_skipped"] += 1
+                logging.info("DATEI: %s - Duplikat von Dokument %s, Upload uebersprungen", data["FileName"], known["doc_id"])
+                return {
+                    "data": data,
+                    "status_code": 200,
+                    "text": f"Duplikat: bereits als Dokument {known['doc_id']} am {known['uploaded']} hochgeladen"
+                }
+
+        file_size = os.path.getsize(new_file_path)
+        with METRICS.timer("upload"):
+            if file_size <= CONFIG.get("small_file_threshold", 0):
+                RUN_STATS["small_uploads"] += 1
+                # Chunked would need one POST per chunk plus the Fields PUT
+                first_chunk = max(chunk_size, CONFIG.get("chunk_size_min", 0)) if CONFIG.get("adaptive_chunks") else chunk_size
+                RUN_STATS["requests_saved"] += max(1, -(-file_size // first_chunk))
+                result = await upload_small_file(document_data, new_file_path, client, data, url, token_manager)
+            else:
+                result = await upload_big_file(document_data, new_file_path, chunk_size, client, data, url, base_url, token_manager, defer_index, temp_path)
+        if result["status_code"] == 200 or result.get("index_pending"):
+            METRICS.count("bytes_uploaded", file_size)
+        if result.get("index_pending"):
+            # Recorded in the dedup store once index_pending_document succeeds
+            result["dedup_key"] = dedup_key
+            return result
+        if dedup_key and result["status_code"] == 200 and result.get("content_hash"):
+            dedup.record(dedup_key, result["content_hash"], result.get("doc_id"), data["FileName"])
+        return result
     else:
         return {
             "data": data,
@@ -362,175 +1503,1323 @@ async def upload_with_restapi(base_url, data, xml_path, client, url, chunk_size,
         }
 
 
+async def index_pending_document(pending, client, url, token_manager, dedup=None):
+    # Second half of a chunked upload whose Fields PUT was deferred by
+    # upload_big_file. The journal still holds the doc_id, so a failure here
+    # is retried later without sending the file again.
+    data = pending["data"]
+    access_token = await token_manager.get()
+    result = await index_document(pending["index_data"], client, data, url, pending["doc_id"], access_token)
+    if result["status_code"] == 401:
+        # The token may have aged while the document waited in the queue
+        access_token = await token_manager.refresh(access_token)
+        if not access_token:
+            return {"data": data, "status_code": 401, "text": "Unauthorized and token refresh failed"}
+        result = await index_document(pending["index_data"], client, data, url, pending["doc_id"], access_token)
+    if result["status_code"] == 200:
+        await asyncio.to_thread(remove_upload_journal, pending["file_path"], pending.get("temp_path"))
+        result["doc_id"] = pending["doc_id"]
+        result["content_hash"] = pending["content_hash"]
+        if pending.get("dedup_key") and dedup is not None:
+            dedup.record(pending["dedup_key"], pending["content_hash"], pending["doc_id"], data["FileName"])
+    return result
+
+
 # ---------------------------
-# XML parsing (unchanged)
+# Upload scheduler (bounded work queue)
 # ---------------------------
 
-async def get_data_from_xml(xml_path, file):
-    file_path = os.path.join(xml_path, file)
+class UploadScheduler:
+    # Worker coroutines pull documents from a queue. Each upload needs a slot for
+    # its host and room in the shared byte budget, so one huge PDF only holds its
+    # own slot while smaller files keep flowing past it.
+
+    def __init__(self, upload_func, workers=20, max_per_host=20, max_inflight_bytes=256*1024*1024, queue_size=0, on_result=None, limiter=None):
+        self.upload_func = upload_func
+        self.on_result = on_result
+        self.limiter = limiter
+        self.workers = max(1, workers)
+        self.max_per_host = max(1, max_per_host)
+        self.max_inflight_bytes = max(1, max_inflight_bytes)
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.results = []
+        self._host_slots = {}
+        self._inflight_bytes = 0
+        self._queued_send = 0
+        self._budget = asyncio.Condition()
+        self._tasks = []
+        self._started = None
+        self.files_done = 0
+        self.bytes_done = 0
+
+    def start(self):
+        self._started = asyncio.get_running_loop().time()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def submit(self, item, size, host, upload_func=None, on_result=None, budget=None):
+        # upload_func/on_result override the scheduler-wide ones for this job,
+        # which is how several profiles share one scheduler. budget is what the
+        # upload holds in memory (see upload_buffer_bytes), the file size if
+        # not given.
+        budget = size if budget is None else budget
+        await self.queue.put((item, size, host, upload_func or self.upload_func, on_result or self.on_result, budget))
+
+    async def join(self):
+        for _ in self._tasks:
+            await self.queue.put(None)
+        await asyncio.gather(*self._tasks)
+        return self.results
+
+    def _send_cost(self, size):
+        # While uploads are throttled only as many bytes to send go in flight
+        # as the limiter passes in a few seconds. Otherwise every worker would
+        # start an upload that then crawls at rate/workers into its write
+        # timeout. One upload counts at most half of that, so a big file never
+        # keeps small ones from starting. Returns (cost, cap), 0 = unthrottled.
+        cap = self.limiter.inflight_cap() if self.limiter is not None else 0
+        return (min(size, max(1, cap // 2)), cap) if cap else (0, 0)
+
+    async def _acquire_bytes(self, budget, size):
+        # budget is memory held (checked against max_inflight_bytes), size the
+        # bytes to send (checked against the limiter). A file larger than the
+        # memory budget may still run, but only alone.
+        admitted = {}
+
+        def ready():
+            if self._inflight_bytes and self._inflight_bytes + budget > self.max_inflight_bytes:
+                return False
+            cost, cap = self._send_cost(size)
+            if cap and self._queued_send and self._queued_send + cost > cap:
+                return False
+            admitted["cost"] = cost
+            return True
+
+        async with self._budget:
+            await self._budget.wait_for(ready)
+            self._inflight_bytes += budget
+            self._queued_send += admitted["cost"]
+        return admitted["cost"]
+
+    async def _release_bytes(self, budget, cost):
+        async with self._budget:
+            self._inflight_bytes -= budget
+            self._queued_send -= cost
+            self._budget.notify_all()
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            if job is None:
+                break
+            item, size, host, upload_func, on_result, budget = job
+            slots = self._host_slots.setdefault(host, asyncio.Semaphore(self.max_per_host))
+            async with slots:
+                cost = await self._acquire_bytes(budget, size)
+                try:
+                    result = await upload_func(item)
+                except Exception as e:
+                    logging.error("DATEI: %s - Upload abgebrochen: %s", item["OriginalFileName"], str(e))
+                    result = {"data": item, "status_code": "Error", "text": str(e)}
+                finally:
+                    await self._release_bytes(budget, cost)
+            self.files_done += 1
+            self.bytes_done += size
+            if on_result is not None:
+                await on_result(result)
+            else:
+                self.results.append(result)
+
+    def log_throughput(self):
+        if self._started is None:
+            return
+        elapsed = max(asyncio.get_running_loop().time() - self._started, 1e-6)
+        logging.info(
+            "Durchsatz: %d Dateien, %.2f MB in %.1fs - %.2f Dateien/s, %.2f MB/s",
+            self.files_done, self.bytes_done / (1024 * 1024), elapsed,
+            self.files_done / elapsed, self.bytes_done / (1024 * 1024) / elapsed
+        )
+
+
+class IndexingStage:
+    # Runs the Fields PUT of chunked uploads after the UploadScheduler has
+    # released their slot, so the next upload starts while the previous
+    # document is still being indexed. Like the scheduler it is shared by all
+    # profiles; every job brings its own index_func and on_result.
+
+    def __init__(self, workers=10, queue_size=0):
+        self.workers = max(1, workers)
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self._tasks = []
+        self.documents_done = 0
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def submit(self, pending, index_func, on_result):
+        await self.queue.put((pending, index_func, on_result))
+
+    async def join(self):
+        for _ in self._tasks:
+            await self.queue.put(None)
+        await asyncio.gather(*self._tasks)
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            if job is None:
+                break
+            pending, index_func, on_result = job
+            try:
+                result = await index_func(pending)
+            except Exception as e:
+                logging.error("DATEI: %s - Indexierung abgebrochen: %s", pending["data"]["OriginalFileName"], str(e))
+                result = {"data": pending["data"], "status_code": "Error", "text": str(e)}
+            self.documents_done += 1
+            await on_result(result)
+
+# ---------------------------
+# XML parsing (runs in a worker pool, off the event loop)
+# ---------------------------
 
-    data = {
+# Top-level Dokument children that end up in `data`
+DOKUMENT_FIELDS = {
+    "DokumentID": "DokumentID",
+    "Belegnummer": "Belegnummer",
+    "Filename": "FileName",
+    "Dokumenttyp": "DokumentTyp",
+    "Bemerkung": "Bemerkung",
+    "Netto": "Betrag",
+    "Created": "Created",
+}
+# Vorgang children read by fill_data_from_dokument
+VORGANG_FIELDS = ("Vorgangstyp", "Belegdatum", "Projektnummer", "Geschaeftspartner")
+
+
+def empty_xml_data(file):
+    return {
         "OriginalFileName": file, "DokumentID": "", "Belegnummer": "", "FileName": "", "Mandant": "", "DokumentTyp": "", "Bemerkung": "", "Betrag": "", "Created": "", "KundeNr": "", "KundeName": "", "LiefNr": "", "LiefName": "", "Belegdatum": "", "Projektnummer": ""}
 
+
+def fill_data_from_dokument(data, dokument):
+    # `dokument` is the Dokument node as xmltodict returns it (or the subset the
+    # lxml extractor builds), so both engines share the exact same rules
+    data["DokumentID"] = dokument.get("DokumentID", data["DokumentID"]) 
+    data["Belegnummer"] = dokument.get("Belegnummer", data["Belegnummer"]) 
+    data["FileName"] = dokument.get("Filename", data["FileName"]) 
+    ErfassungspartionID = dokument.get("Erfassungspartition_dbid", "")
+    data["Mandant"] = "Wegra" if ErfassungspartionID == "1801" else "EAW"
+    data["DokumentTyp"] = dokument.get("Dokumenttyp", data["DokumentTyp"]) 
+    data["Bemerkung"] = dokument.get("Bemerkung", data["Bemerkung"]) 
+    data["Betrag"] = dokument.get("Netto", data["Betrag"]) 
+    data["Created"] = dokument.get("Created", data["Created"]) 
+    searchVorgang = "not Found"
+
+    try:
+        for i, doc in enumerate(dokument["Vorgang"]):
+            try:
+                data["KundeNr"] = dokument["Vorgang"][i]["Geschaeftspartner"].get("Kundennummer", dokument["Vorgang"][i]["Geschaeftspartner"].get("Lieferantennummer", data["KundeNr"]))
+                data["KundeName"] = dokument["Vorgang"][i]["Geschaeftspartner"].get("Name", data["KundeName"]) 
+            except:
+                pass
+            data["Belegdatum"] = dokument["Vorgang"][i].get("Belegdatum", data["Belegdatum"]) 
+            data["Belegdatum"] = remove_timezone_offset(data["Belegdatum"]) 
+            data["Projektnummer"] = dokument["Vorgang"][i].get("Projektnummer", data["Projektnummer"]) 
+
+            match data["DokumentTyp"]:
+                case "Eingangsrechnung":
+                    searchVorgang = "EingangsRechnungImpl"
+                    if doc["Vorgangstyp"] == searchVorgang:
+                        data["LiefNr"] = dokument["Vorgang"][i]["Geschaeftspartner"].get("Lieferantennummer", data["LiefNr"]) 
+                        data["LiefName"] = dokument["Vorgang"][i]["Geschaeftspartner"].get("Name", data["LiefName"]) 
+                        data["Belegdatum"] = dokument["Vorgang"][i].get("Belegdatum", data["Belegdatum"]) 
+                        data["Belegdatum"] = remove_timezone_offset(data["Belegdatum"]) 
+                        data["Projektnummer"] = dokument["Vorgang"][i].get("Projektnummer", "")  
+    except:
+        pass
+    data["status"] = "Success"
+    return data
+
+
+@functools.lru_cache(maxsize=None)
+def compiled_xpath(expression):
+    # Cached per process, XPath objects cannot be sent to a process pool
+    return etree.XPath(expression)
+
+
+def evaluate_xpaths(root, xpaths):
+    # Values for the "xpath" entries of the field mapping: string results as
+    # they are, node sets by the stripped text of their first node
+    values = {}
+    for expression in xpaths:
+        result = compiled_xpath(expression)(root)
+        if isinstance(result, list):
+            result = result[0] if result else ""
+        if isinstance(result, etree._Element):
+            result = result.text or ""
+        if isinstance(result, bool):
+            result = "true" if result else ""
+        elif isinstance(result, float):
+            result = "" if result != result else (str(int(result)) if result.is_integer() else str(result))
+        values[expression] = str(result).strip()
+    return values
+
+
+def extract_data_xmltodict(file_path, file, xpaths=()):
+    data = empty_xml_data(file)
     with open(file_path, 'r', encoding='utf-8') as xml_file:
-        logging.debug("Reading XML File: %s", file)
-        xml_content = xml_file.read()
-        xml_dict = xmltodict.parse(xml_content, force_list=('Vorgang',))
-
-        data["DokumentID"] = xml_dict["Dokument"].get("DokumentID", data["DokumentID"]) 
-        data["Belegnummer"] = xml_dict["Dokument"].get("Belegnummer", data["Belegnummer"]) 
-        data["FileName"] = xml_dict["Dokument"].get("Filename", data["FileName"]) 
-        ErfassungspartionID = xml_dict["Dokument"].get("Erfassungspartition_dbid", "")
-        data["Mandant"] = "Wegra" if ErfassungspartionID == "1801" else "EAW"
-        data["DokumentTyp"] = xml_dict["Dokument"].get("Dokumenttyp", data["DokumentTyp"]) 
-        data["Bemerkung"] = xml_dict["Dokument"].get("Bemerkung", data["Bemerkung"]) 
-        data["Betrag"] = xml_dict["Dokument"].get("Netto", data["Betrag"]) 
-        data["Created"] = xml_dict["Dokument"].get("Created", data["Created"]) 
-        searchVorgang = "not Found"
+        xml_dict = xmltodict.parse(xml_file.read(), force_list=('Vorgang',))
+    data = fill_data_from_dokument(data, xml_dict["Dokument"])
+    if xpaths:
+        data["xpath"] = evaluate_xpaths(etree.parse(file_path).getroot(), xpaths)
+    return data
 
+
+def _xml_node(elem, only=None):
+    # Mirrors xmltodict for the few nodes we need: leaf -> stripped text or None,
+    # otherwise a dict of (selected) children, repeated tags become lists
+    children = [c for c in elem.iterchildren(tag=etree.Element) if only is None or etree.QName(c).localname in only]
+    if not children and not len(elem):
+        return (elem.text or "").strip() or None
+    node = {}
+    for child in children:
+        key = etree.QName(child).localname
+        value = _xml_node(child)
+        if key in node:
+            if not isinstance(node[key], list):
+                node[key] = [node[key]]
+            node[key].append(value)
+        else:
+            node[key] = value
+    return node
+
+
+def extract_data_lxml(file_path, file, xpaths=()):
+    # Only materializes the Dokument/Vorgang fields we actually read
+    data = empty_xml_data(file)
+    root = etree.parse(file_path).getroot()
+    if etree.QName(root).localname != "Dokument":
+        raise KeyError("Dokument")
+    dokument = {}
+    for child in root.iterchildren(tag=etree.Element):
+        key = etree.QName(child).localname
+        if key == "Vorgang":
+            dokument.setdefault("Vorgang", []).append(_xml_node(child, VORGANG_FIELDS))
+        elif key in DOKUMENT_FIELDS or key == "Erfassungspartition_dbid":
+            dokument[key] = _xml_node(child)
+    data = fill_data_from_dokument(data, dokument)
+    if xpaths:
+        data["xpath"] = evaluate_xpaths(root, xpaths)
+    return data
+
+
+PARSE_ENGINES = {
+    "lxml": extract_data_lxml,
+    "xmltodict": extract_data_xmltodict,
+}
+
+
+def parse_xml_file(xml_path, file, engine="lxml", xpaths=()):
+    # Top-level so it can be shipped to a ProcessPoolExecutor
+    return PARSE_ENGINES.get(engine, extract_data_lxml)(os.path.join(xml_path, file), file, xpaths)
+
+
+def create_parse_executor(kind, workers):
+    if kind == "process":
+        return ProcessPoolExecutor(max_workers=max(1, workers))
+    if kind == "thread":
+        return ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="xml-parse")
+    return None
+
+
+async def get_data_from_xml(xml_path, file, executor=None, engine="lxml", xpaths=()):
+    logging.debug("Reading XML File: %s", file)
+    with METRICS.timer("parse"):
+        if executor is None:
+            data = parse_xml_file(xml_path, file, engine, xpaths)
+        else:
+            data = await asyncio.get_running_loop().run_in_executor(executor, parse_xml_file, xml_path, file, engine, xpaths)
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("FILE: %s - Logging data object as JSON: %s", data['OriginalFileName'], json.dumps(data))
+    logging.info("reading through XML file completed: %s",file)
+    return data
+
+# ---------------------------
+# Inbox index (SQLite in temp_path)
+# ---------------------------
+
+class InboxIndex:
+    # Remembers XML/binary pairs by name, size and mtime across runs, so a run
+    # only processes pairs that are new or changed since their last upload.
+    # The snapshot taken by scan() also serves the binaries' sizes without
+    # touching the (possibly remote) inbox again.
+
+    def __init__(self, db_path):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            " folder TEXT NOT NULL, name TEXT NOT NULL, size INTEGER, mtime_ns INTEGER, state TEXT,"
+            " bin_name TEXT, bin_size INTEGER, bin_mtime_ns INTEGER, updated TEXT,"
+            " PRIMARY KEY (folder, name))"
+        )
+        # Failed uploads in a row, added after the first release of the table
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(files)")}
+        if "attempts" not in columns:
+            self.db.execute("ALTER TABLE files ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+        self.db.commit()
+        self._lock = threading.Lock()
+        self.folder = None
+        self.entries = {}
+        self.inflight = set()
+
+    def scan(self, folder_path, retry_failed=True, settle_seconds=0, retry_after_seconds=None, max_attempts=3):
+        # One directory pass; returns the XML names that still need processing.
+        # Names handed out stay in `inflight` until mark() records the outcome,
+        # so a rescan during a long-running service never queues them twice.
+        # Without retry_failed an unchanged failed pair is offered again only
+        # once retry_after_seconds have passed since its last attempt, and at
+        # most max_attempts times in a row.
+        entries = {}
+        with os.scandir(folder_path) as it:
+            for entry in it:
+                if not entry.is_file():
+                    continue
+                st = entry.stat()
+                entries[entry.name] = (st.st_size, st.st_mtime_ns)
+
+        pending = []
+        total = 0
+        settled_before = time.time_ns() - int(settle_seconds * 1e9)
+        if retry_after_seconds is not None:
+            retry_before = (datetime.now() - timedelta(seconds=retry_after_seconds)).isoformat()
+        # Rows and `inflight` are read under the lock mark() writes them under,
+        # so a document finishing meanwhile is seen either in flight or with
+        # its final state, never as a stale "parsed" row outside `inflight`
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT name, size, mtime_ns, state, bin_name, bin_size, bin_mtime_ns, updated, attempts FROM files WHERE folder = ?",
+                (folder_path,)
+            ).fetchall()
+            known = {row[0]: row[1:] for row in rows}
+            gone = [(folder_path, name) for name in known if name not in entries]
+            self.db.executemany("DELETE FROM files WHERE folder = ? AND name = ?", gone)
+            self.db.commit()
+
+            for name, (size, mtime_ns) in entries.items():
+                if not name.endswith(".xml"):
+                    continue
+                total += 1
+                if name in self.inflight:
+                    continue
+                row = known.get(name)
+                if row and row[0] == size and row[1] == mtime_ns:
+                    bin_name, bin_size, bin_mtime_ns = row[3:6]
+                    recorded = (bin_size, bin_mtime_ns) if bin_size is not None else None
+                    current = entries.get(bin_name) if bin_name else None
+                    if row[2] == "uploaded" and (current is None or current == recorded):
+                        continue
+                    if row[2] == "failed" and not retry_failed and current == recorded:
+                        due = retry_after_seconds is not None and row[6] <= retry_before and row[7] < max_attempts
+                        if not due:
+                            continue
+                if settle_seconds and mtime_ns > settled_before:
+                    # Still being written, picked up by a later scan
+                    continue
+                pending.append(name)
+
+            self.folder = folder_path
+            self.entries = entries
+            self.inflight.update(pending)
+        logging.log(
+            logging.INFO if pending or retry_failed else logging.DEBUG,
+            "Inbox %s: %d XML-Dateien, %d neu oder geaendert, %d uebersprungen", folder_path, total, len(pending), total - len(pending)
+        )
+        return pending
+
+    def stat(self, name):
+        # (size, mtime_ns) from the last scan, None if the file was not there
+        return self.entries.get(name)
+
+    def mark(self, name, state, bin_name=""):
+        xml_stat = self.entries.get(name)
+        if xml_stat is None:
+            try:
+                st = os.stat(os.path.join(self.folder or "", name))
+                xml_stat = (st.st_size, st.st_mtime_ns)
+            except OSError:
+                xml_stat = None
+        bin_stat = self.entries.get(bin_name) if bin_name else None
+        with self._lock:
+            # The row is written before the name leaves `inflight`, see scan()
+            if xml_stat is not None:
+                # "parsed" keeps the count, "failed" adds one, "uploaded" resets it
+                row = self.db.execute(
+                    "SELECT attempts FROM files WHERE folder = ? AND name = ?", (self.folder, name)
+                ).fetchone()
+                attempts = row[0] if row else 0
+                if state == "failed":
+                    attempts += 1
+                elif state == "uploaded":
+                    attempts = 0
+                self.db.execute(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (self.folder, name, xml_stat[0], xml_stat[1], state, bin_name,
+                     bin_stat[0] if bin_stat else None, bin_stat[1] if bin_stat else None,
+                     datetime.now().isoformat(), attempts)
+                )
+                self.db.commit()
+            if state != "parsed":
+                self.inflight.discard(name)
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
+# ---------------------------
+# Deduplication store (SQLite in temp_path)
+# ---------------------------
+
+class DedupStore:
+    # Remembers uploaded documents by DokumentID and SHA-256 of the binary, so a
+    # re-exported or re-run document is not sent to the file cabinet twice.
+    # Entries expire after ttl_days; beyond max_entries the least recently
+    # used ones are dropped.
+
+    def __init__(self, db_path, ttl_days=90, max_entries=100000):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            " dokument_id TEXT NOT NULL, content_hash TEXT NOT NULL, doc_id TEXT, file_name TEXT,"
+            " uploaded TEXT, last_used REAL,"
+            " PRIMARY KEY (dokument_id, content_hash))"
+        )
+        self._lock = threading.Lock()
+        self._evict(ttl_days, max_entries)
+
+    def _evict(self, ttl_days, max_entries):
+        with self._lock:
+            if ttl_days:
+                self.db.execute("DELETE FROM documents WHERE last_used < ?", (time.time() - ttl_days * 86400,))
+            if max_entries:
+                self.db.execute(
+                    "DELETE FROM documents WHERE rowid IN ("
+                    " SELECT rowid FROM documents ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                    (max_entries,)
+                )
+            self.db.commit()
+
+    def has(self, dokument_id):
+        with self._lock:
+            return self.db.execute("SELECT 1 FROM documents WHERE dokument_id = ? LIMIT 1", (dokument_id,)).fetchone() is not None
+
+    def lookup(self, dokument_id, content_hash):
+        with self._lock:
+            row = self.db.execute(
+                "SELECT doc_id, file_name, uploaded FROM documents WHERE dokument_id = ? AND content_hash = ?",
+                (dokument_id, content_hash)
+            ).fetchone()
+            if row is None:
+                return None
+            self.db.execute(
+                "UPDATE documents SET last_used = ? WHERE dokument_id = ? AND content_hash = ?",
+                (time.time(), dokument_id, content_hash)
+            )
+            self.db.commit()
+        return {"doc_id": row[0], "file_name": row[1], "uploaded": row[2]}
+
+    def record(self, dokument_id, content_hash, doc_id, file_name):
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?)",
+                (dokument_id, content_hash, None if doc_id is None else str(doc_id), file_name,
+                 datetime.now().isoformat(timespec="seconds"), time.time())
+            )
+            self.db.commit()
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
+# ---------------------------
+# Failed-document retry ledger (SQLite in temp_path)
+# ---------------------------
+
+class RetryLedger:
+    # Counts upload attempts of documents that ended up in error_path. Pairs
+    # that failed for a transient reason (server errors, timeouts, an open
+    # circuit) are moved back into the inbox by requeue_failed() until they
+    # have used up max_attempts; the counter survives the round trip.
+
+    def __init__(self, db_path, max_attempts=3):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS failed ("
+            " name TEXT PRIMARY KEY, bin_name TEXT, location TEXT, attempts INTEGER,"
+            " retryable INTEGER, last_error TEXT, last_failed REAL)"
+        )
+        self.db.commit()
+        self._lock = threading.Lock()
+        self.max_attempts = max_attempts
+
+    def record_failure(self, name, bin_name, location, error, retryable):
+        with self._lock:
+            row = self.db.execute("SELECT attempts FROM failed WHERE name = ?", (name,)).fetchone()
+            attempts = (row[0] if row else 0) + 1
+            self.db.execute(
+                "INSERT OR REPLACE INTO failed VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (name, bin_name, location, attempts, int(retryable), str(error)[:500], time.time())
+            )
+            self.db.commit()
+        if retryable and attempts >= self.max_attempts:
+            logging.warning("DATEI: %s - nach %d Versuchen endgueltig fehlgeschlagen, bleibt in %s", name, attempts, location)
+        return attempts
+
+    def record_success(self, name):
+        with self._lock:
+            self.db.execute("DELETE FROM failed WHERE name = ?", (name,))
+            self.db.commit()
+
+    def due(self, min_age_seconds=0):
+        with self._lock:
+            return self.db.execute(
+                "SELECT name, bin_name, location, attempts FROM failed"
+                " WHERE retryable = 1 AND location IS NOT NULL AND attempts < ? AND last_failed <= ?",
+                (self.max_attempts, time.time() - min_age_seconds)
+            ).fetchall()
+
+    def requeued(self, name):
+        with self._lock:
+            self.db.execute("UPDATE failed SET location = NULL WHERE name = ?", (name,))
+            self.db.commit()
+
+    def forget(self, name):
+        self.record_success(name)
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
+def is_transient_failure(data):
+    # Parse errors, a missing binary and 4xx rejections fail the same way on
+    # every attempt; everything else may succeed later
+    if data["data"]["status"] != "Success":
+        return False
+    code = data["status_code"]
+    if isinstance(code, int):
+        return code in RETRYABLE_STATUS or code == 401
+    return code != "File Not Found"
+
+
+def requeue_failed(ledger, folder_path, min_age_seconds=0):
+    # Moves transiently failed pairs from error_path back into the inbox
+    requeued = 0
+    for name, bin_name, location, attempts in ledger.due(min_age_seconds):
+        xml_src = os.path.join(location, name)
+        bin_src = os.path.join(location, bin_name)
+        if not (os.path.isfile(xml_src) and os.path.isfile(bin_src)):
+            # Moved or deleted by hand
+            ledger.forget(name)
+            continue
         try:
-            for i, doc in enumerate(xml_dict["Dokument"]["Vorgang"]):
-                try:
-                    data["KundeNr"] = xml_dict["Dokument"]["Vorgang"][i]["Geschaeftspartner"].get("Kundennummer", xml_dict["Dokument"]["Vorgang"][i]["Geschaeftspartner"].get("Lieferantennummer", data["KundeNr"]))
-                    data["KundeName"] = xml_dict["Dokument"]["Vorgang"][i]["Geschaeftspartner"].get("Name", data["KundeName"]) 
-                except:
-                    pass
-                data["Belegdatum"] = xml_dict["Dokument"]["Vorgang"][i].get("Belegdatum", data["Belegdatum"]) 
-                data["Belegdatum"] = remove_timezone_offset(data["Belegdatum"]) 
-                data["Projektnummer"] = xml_dict["Dokument"]["Vorgang"][i].get("Projektnummer", data["Projektnummer"]) 
-
-                match data["DokumentTyp"]:
-                    case "Eingangsrechnung":
-                        searchVorgang = "EingangsRechnungImpl"
-                        if doc["Vorgangstyp"] == searchVorgang:
-                            data["LiefNr"] = xml_dict["Dokument"]["Vorgang"][i]["Geschaeftspartner"].get("Lieferantennummer", data["LiefNr"]) 
-                            data["LiefName"] = xml_dict["Dokument"]["Vorgang"][i]["Geschaeftspartner"].get("Name", data["LiefName"]) 
-                            data["Belegdatum"] = xml_dict["Dokument"]["Vorgang"][i].get("Belegdatum", data["Belegdatum"]) 
-                            data["Belegdatum"] = remove_timezone_offset(data["Belegdatum"]) 
-                            data["Projektnummer"] = xml_dict["Dokument"]["Vorgang"][i].get("Projektnummer", "")  
-        except:
-            pass
-        data["status"] = "Success"
-        logging.debug("FILE: %s - Logging data object as JSON: %s", data['OriginalFileName'],json.dumps(data))
-        logging.info("reading through XML file completed: %s",file)
-        return data
+            move_file(bin_src, os.path.join(folder_path, bin_name))
+            move_file(xml_src, os.path.join(folder_path, name))
+        except OSError as e:
+            logging.error("DATEI: %s - Wiederholung nicht moeglich: %s", name, str(e))
+            continue
+        ledger.requeued(name)
+        requeued += 1
+        logging.info("DATEI: %s - aus %s zur Wiederholung in die Inbox verschoben (Versuch %d)", name, location, attempts + 1)
+    if requeued:
+        METRICS.count("documents_requeued", requeued)
+    return requeued
+
+
+async def requeue_loop(ledger, folder_path, min_age_seconds, interval):
+    # Service mode: returns due documents to the inbox, the watcher picks them up
+    while True:
+        await asyncio.to_thread(requeue_failed, ledger, folder_path, min_age_seconds)
+        await asyncio.sleep(interval)
+
+
+# ---------------------------
+# Streaming pipeline (parse -> upload -> archive)
+# ---------------------------
+
+async def scan_inbox(folder_path, index=None):
+    if index is not None:
+        for name in await asyncio.to_thread(index.scan, folder_path):
+            yield name
+        return
+    # Lazily yields XML file names so huge inboxes are never held in one list
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            if entry.name.endswith(".xml") and entry.is_file():
+                yield entry.name
+
+
+def start_observer(folder_path, wake):
+    # File system notifications (inotify on Linux, ReadDirectoryChangesW on
+    # Windows) through the optional watchdog package; None means polling
+    try:
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+    except ImportError:
+        return None
+    loop = asyncio.get_running_loop()
+
+    class WakeHandler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            if not event.is_directory:
+                loop.call_soon_threadsafe(wake.set)
+
+    observer = Observer()
+    observer.schedule(WakeHandler(), folder_path, recursive=False)
+    observer.start()
+    return observer
+
+
+async def watch_inbox(folder_path, index, poll_interval=5, rescan_interval=60, settle_seconds=2, stop=None, retry_after_seconds=None, max_attempts=3):
+    # Source for parse_stage in service mode. A file system event triggers a
+    # rescan once the pair had settle_seconds to finish landing; without
+    # events (or as a safety net) the inbox is rescanned periodically. Ends
+    # once stop() returns True, otherwise runs forever. A missing or
+    # unreachable inbox is retried every poll_interval. Failed pairs that
+    # stay in the inbox come back after retry_after_seconds (see
+    # InboxIndex.scan).
+    wake = asyncio.Event()
+    try:
+        observer = start_observer(folder_path, wake)
+    except OSError as e:
+        logging.warning("Dienstmodus: %s nicht per Ereignissen ueberwachbar (%s)", folder_path, str(e))
+        observer = None
+    interval = rescan_interval if observer is not None else poll_interval
+    if observer is not None:
+        logging.info("Dienstmodus: ueberwache %s per Dateisystem-Ereignissen", folder_path)
+    else:
+        logging.info("Dienstmodus: ueberwache %s per Polling alle %ss", folder_path, poll_interval)
+    unreadable = False
+    try:
+        while stop is None or not stop():
+            wake.clear()
+            try:
+                names = await asyncio.to_thread(
+                    index.scan, folder_path, False, settle_seconds, retry_after_seconds, max_attempts
+                )
+            except OSError as e:
+                # Logged once per outage, a dated inbox may not exist for hours
+                if not unreadable:
+                    logging.error("Inbox %s nicht lesbar: %s - neuer Versuch alle %ss", folder_path, str(e), poll_interval)
+                unreadable = True
+                await asyncio.sleep(poll_interval)
+                continue
+            if unreadable:
+                logging.info("Inbox %s wieder lesbar", folder_path)
+                unreadable = False
+            for name in names:
+                yield name
+            try:
+                await asyncio.wait_for(wake.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                continue
+            await asyncio.sleep(settle_seconds)
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+
+
+async def parse_stage(xml_names, folder_path, scheduler, host, on_failed, workers=4, queue_size=100, executor=None, engine="lxml", index=None, mapping=None, upload_func=None, on_result=None, budget_func=None):
+    # Parses XML files with a few workers and hands each document to the upload
+    # scheduler as soon as it is ready. The bounded queues provide backpressure.
+    names = asyncio.Queue(maxsize=queue_size)
+    xpaths = (mapping or FIELD_MAPPING).xpaths
+
+    async def worker():
+        while True:
+            f = await names.get()
+            if f is None:
+                break
+            try:
+                item = await get_data_from_xml(folder_path, f, executor, engine, xpaths)
+            except Exception as e:
+                logging.error("DATEI: %s - Fehler beim Lesen der XML: %s", f, str(e))
+                item = {"OriginalFileName": f, "FileName": "", "status": "Failed", "error": str(e)}
+                # archive_result marks it failed in the index, once per attempt
+                await on_failed({"data": item, "status_code": "Not Uploaded", "text": "XML konnte nicht gelesen werden"})
+                continue
+            bin_stat = index.stat(item["FileName"]) if index is not None and item["FileName"] else None
+            if bin_stat is not None:
+                size = bin_stat[0]
+            else:
+                bin_path = os.path.join(folder_path, item["FileName"] or "")
+                size = os.path.getsize(bin_path) if os.path.isfile(bin_path) else 0
+            if index is not None:
+                index.mark(f, "parsed", item["FileName"])
+            budget = budget_func(size) if budget_func is not None else None
+            await scheduler.submit(item, size, host, upload_func, on_result or on_failed, budget)
+
+    tasks = [asyncio.create_task(worker()) for _ in range(max(1, workers))]
+    drain = True
+    try:
+        async for f in xml_names:
+            await names.put(f)
+    except asyncio.CancelledError:
+        drain = False
+        for task in tasks:
+            task.cancel()
+        raise
+    finally:
+        # Also when the inbox fails mid-scan: names already queued are parsed
+        # and handed to the scheduler before the error reaches the caller
+        if drain:
+            for _ in tasks:
+                await names.put(None)
+            await asyncio.gather(*tasks)
+
+
+def move_file(src, dst):
+    # os.replace within one filesystem. Across devices (inbox on a local disk,
+    # backup on a share) the file is copied next to its target, flushed to
+    # disk, renamed into place and only then removed from the source.
+    try:
+        os.replace(src, dst)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV and getattr(e, "winerror", None) != 17:
+            raise
+    tmp_dst = dst + ".part"
+    with open(src, "rb") as fsrc, open(tmp_dst, "wb") as fdst:
+        shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+        fdst.flush()
+        os.fsync(fdst.fileno())
+    shutil.copystat(src, tmp_dst)
+    os.replace(tmp_dst, dst)
+    os.unlink(src)
+
+
+def compress_backups(backup_path, fmt="zip", keep_days=1):
+    # Packs the run folders of each finished day (backup/<YYYYMMDD...>) into
+    # one backup/<YYYYMMDD>.zip or .tar.gz and removes the folders afterwards
+    extension = {"zip": ".zip", "tar": ".tar.gz"}.get(fmt)
+    if extension is None:
+        logging.error("Unbekanntes Archivformat %r (zip oder tar)", fmt)
+        return 0
+    # keep_days counts today, so 1 packs everything up to yesterday. Today
+    # is never packed, its folders are still being written.
+    cutoff = (datetime.now() - timedelta(days=max(1, keep_days) - 1)).strftime("%Y%m%d")
+    days = {}
+    with os.scandir(backup_path) as it:
+        for entry in it:
+            if entry.is_dir() and entry.name[:8].isdigit() and len(entry.name) >= 8 and entry.name[:8] < cutoff:
+                days.setdefault(entry.name[:8], []).append(entry.name)
+    for day, folders in sorted(days.items()):
+        target = os.path.join(backup_path, day + extension)
+        number = 1
+        while os.path.exists(target):
+            number += 1
+            target = os.path.join(backup_path, f"{day}_{number}{extension}")
+        tmp_target = target + ".part"
+        started = time.perf_counter()
+        count = 0
+        if fmt == "zip":
+            archive = zipfile.ZipFile(tmp_target, "w", zipfile.ZIP_DEFLATED)
+            add = archive.write
+        else:
+            archive = tarfile.open(tmp_target, "w:gz")
+            add = archive.add
+        with archive:
+            for folder in sorted(folders):
+                for root, _, files in os.walk(os.path.join(backup_path, folder)):
+                    for name in sorted(files):
+                        path = os.path.join(root, name)
+                        add(path, os.path.relpath(path, backup_path))
+                        count += 1
+        with open(tmp_target, "rb+") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_target, target)
+        for folder in folders:
+            shutil.rmtree(os.path.join(backup_path, folder))
+        logging.info("Backup %s: %d Dateien aus %d Ordnern in %s gepackt (%.1fs)", day, count, len(folders), os.path.basename(target), time.perf_counter() - started)
+    return len(days)
+
+
+async def compress_loop(backup_path, fmt, keep_days, interval=None):
+    # Runs once per batch run; the service passes an interval and packs each
+    # day once it is over
+    while True:
+        try:
+            await asyncio.to_thread(compress_backups, backup_path, fmt, keep_days)
+        except OSError as e:
+            logging.error("Backup-Archiv konnte nicht erstellt werden: %s", str(e))
+        if interval is None:
+            return
+        await asyncio.sleep(interval)
+
+
+def archive_result(data, folder_path, subbackup_path, suberror_path, temp_solution, index=None, ledger=None):
+    if data["data"]["status"] == "Success":
+        logging.info("[ERFOLG] - DATEI: %s - 'get_data_from_xml()' - Status: %s - Nachricht: %s", data["data"]["OriginalFileName"], data["data"]["status"], data["data"].get("error", "Erfolg"))
+    else:
+        logging.error("[FEHLER] - DATEI: %s - 'get_data_from_xml()' - Status: %s - Nachricht: %s", data["data"]["OriginalFileName"], data["data"]["status"], data["data"].get("error", "Fehler"))
+
+    if data["status_code"] == 200:
+        logging.info("[ERFOLG] - DATEI: %s - 'upload_with_restapi()' - Status: %s - Nachricht: %s", data["data"]["OriginalFileName"], data["status_code"], data["text"])
+    else:
+        logging.error("[FEHLER] - DATEI: %s - 'upload_with_restapi()' - Status: %s - Nachricht: %s", data["data"]["OriginalFileName"], data["status_code"], data["text"])
+
+    uploaded = data["data"]["status"] == "Success" and data["status_code"] == 200
+    METRICS.count("files_uploaded" if uploaded else "files_failed")
+    if index is not None:
+        index.mark(data["data"]["OriginalFileName"], "uploaded" if uploaded else "failed", data["data"].get("FileName", ""))
+
+    if not temp_solution:
+        try:
+            xml_src = os.path.join(folder_path, data["data"]["OriginalFileName"]) 
+            bin_src = os.path.join(folder_path, data["data"]["FileName"]) 
+            if data["data"]["status"] == "Success" and data["status_code"] == 200:
+                if os.path.isfile(xml_src) and os.path.isfile(bin_src):
+                    os.makedirs(subbackup_path, exist_ok=True)
+                    move_file(xml_src, os.path.join(subbackup_path, data["data"]["OriginalFileName"]))
+                    move_file(bin_src, os.path.join(subbackup_path, data["data"]["FileName"]))
+                if ledger is not None:
+                    ledger.record_success(data["data"]["OriginalFileName"])
+            elif data["data"]["status"] == "Failed" or data["status_code"] != 200:
+                if os.path.isfile(xml_src) and os.path.isfile(bin_src):
+                    os.makedirs(suberror_path, exist_ok=True)
+                    move_file(xml_src, os.path.join(suberror_path, data["data"]["OriginalFileName"]))
+                    move_file(bin_src, os.path.join(suberror_path, data["data"]["FileName"]))
+                    if ledger is not None:
+                        ledger.record_failure(
+                            data["data"]["OriginalFileName"], data["data"]["FileName"], suberror_path,
+                            data["data"].get("error") or f'{data["status_code"]} {data["text"]}', is_transient_failure(data)
+                        )
+        except Exception as e:
+            logging.error("DATEI: %s - Fehler: %s", data["data"]["OriginalFileName"], str(e))
+
+
+async def archive_stage(results, folder_path, archive_dirs, temp_solution, index=None, ledger=None, workers=4):
+    # Archives each document as soon as its upload has finished, on a thread
+    # pool so slow moves to a network share neither block the event loop nor
+    # each other. archive_dirs() returns the (backup, error) subfolders to use
+    # for this document.
+    def archive_one(data, subbackup_path, suberror_path):
+        try:
+            with METRICS.timer("archive"):
+                archive_result(data, folder_path, subbackup_path, suberror_path, temp_solution, index, ledger)
+        except Exception as e:
+            logging.error("DATEI: %s - Archivierung fehlgeschlagen: %s", data["data"]["OriginalFileName"], str(e))
+
+    loop = asyncio.get_running_loop()
+    workers = max(1, workers)
+    slots = asyncio.Semaphore(workers * 2)
+    pending = set()
+
+    def finished(future):
+        pending.discard(future)
+        slots.release()
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="archive") as executor:
+        while True:
+            data = await results.get()
+            if data is None:
+                break
+            subbackup_path, suberror_path = archive_dirs()
+            await slots.acquire()
+            future = loop.run_in_executor(executor, archive_one, data, subbackup_path, suberror_path)
+            pending.add(future)
+            future.add_done_callback(finished)
+        if pending:
+            await asyncio.gather(*pending)
+
+
+async def report_loop(scheduler, minutes, write_metrics=None):
+    # Periodic throughput line for the long-running service mode
+    while True:
+        await asyncio.sleep(minutes * 60)
+        scheduler.log_throughput()
+        logging.info("Kleine Dateien: %d per Einzelanfrage hochgeladen, %d Anfragen eingespart", RUN_STATS["small_uploads"], RUN_STATS["requests_saved"])
+        logging.info("Duplikate: %d Uploads uebersprungen", RUN_STATS["duplicates_skipped"])
+        if write_metrics is not None:
+            await asyncio.to_thread(write_metrics)
 
 # ---------------------------
 # MAIN (token-based)
 # ---------------------------
 
-async def main():
-    global CONFIG
+def http_transport_config(config_data):
+    # Pool limits, per-phase timeouts and HTTP/2 for the one AsyncClient that
+    # carries token, chunk and indexing requests
+    http2 = config_data["http2"]
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logging.warning("HTTP/2 aktiviert, aber das Paket 'h2' fehlt (pip install httpx[http2]) - verwende HTTP/1.1")
+            http2 = False
+    return {
+        'http2': http2,
+        'limits': httpx.Limits(
+            max_connections=config_data["http_max_connections"],
+            max_keepalive_connections=config_data["http_max_keepalive"],
+            keepalive_expiry=config_data["http_keepalive_expiry"],
+        ),
+        'timeout': httpx.Timeout(
+            connect=config_data["http_connect_timeout"],
+            read=config_data["http_read_timeout"],
+            write=config_data["http_write_timeout"],
+            pool=config_data["http_pool_timeout"],
+        ),
+    }
+
+
+class Profile:
+    # One cabinet (Mandant) of a run: its own inbox, archive folders,
+    # credentials, token file, field mapping and SQLite stores under its
+    # temp_path. Every profile has its own AsyncClient because each cabinet can
+    # need a different certificate or proxy; the UploadScheduler, and with it
+    # the worker, per-host and byte budget, is shared by all profiles.
+
+    def __init__(self, name, config_data, global_data, watch=False, run_datetime=""):
+        self.name = name
+        self.config_data = config_data
+        self.watch = watch
+        self.temp_solution = config_data["temp_solution"]
+        self.folder_path = self.inbox_folder()
+        self.backup_path = config_data["backup_path"]
+        self.error_path = config_data["error_path"]
+        self.subbackup_path = os.path.join(self.backup_path, run_datetime)
+        self.suberror_path = os.path.join(self.error_path, run_datetime)
+        self.token_settings = {
+            key: config_data[key] for key in ("token_endpoint", "username", "password", "token_file", "temp_path")
+        }
+        self.mapping = FieldMapping(config_data["index_fields"] or DEFAULT_FIELD_MAPPING)
+        self.base_url = f"{config_data['scheme']}://{config_data['company_url']}/"
+        self.url = f"{self.base_url}docuware/platform/FileCabinets/{config_data['file_cabinet_guid']}/Documents"
+        self.host = urllib.parse.urlsplit(self.url).netloc
+        self.chunk_size = config_data["chunk_size"]
+        cert_file = config_data["cert_file_fiddler"] if config_data["fiddler"] else config_data["cert_file"]
+        self.client_config = {
+            'verify': cert_file if cert_file else True,
+            'proxies': {
+                "http://": "http://localhost:8888",
+                "https://": "http://localhost:8888",
+            } if config_data["fiddler"] else None,
+            **http_transport_config(global_data),
+        }
+        self.client = None
+        self.token_manager = None
+        self.index = None
+        self.dedup = None
+        self.ledger = None
+        self.archive_queue = None
+        self.archiver = None
+        self.compressor = None
+        self.requeuer = None
+        self.indexer = None
+
+    def inbox_folder(self):
+        # With temp_solution the inbox is one folder per day. It is resolved
+        # again for every day a service runs.
+        if self.temp_solution:
+            return os.path.join(self.config_data["folder_path"], datetime.now().strftime("%Y%m%d"))
+        return self.config_data["folder_path"]
+
+    def archive_dirs(self):
+        if not self.watch:
+            return self.subbackup_path, self.suberror_path
+        # A service runs for days, so it archives into one folder per day
+        current_day = datetime.now().strftime("%Y%m%d")
+        return os.path.join(self.backup_path, current_day), os.path.join(self.error_path, current_day)
+
+    async def open(self):
+        # Returns False if the profile cannot run; the other profiles go on
+        config_data = self.config_data
+        os.makedirs(self.backup_path, exist_ok=True)
+        os.makedirs(self.error_path, exist_ok=True)
+        self.client = httpx.AsyncClient(**self.client_config)
+        logging.debug("Profil %s: verbinden mit %s", self.name, self.url)
+
+        self.token_manager = TokenManager(self.client, config_data["token_refresh_margin"], self.token_settings)
+        if not await self.token_manager.get():
+            logging.critical("Profil %s: Token retrieval failed, Profil wird uebersprungen.", self.name)
+            return False
+
+        # Service mode always needs the index to tell new files from old ones
+        if config_data["incremental"] or self.watch:
+            self.index = InboxIndex(os.path.join(config_data["temp_path"], "inbox_index.sqlite3"))
+        if config_data["dedup_enabled"]:
+            self.dedup = DedupStore(
+                os.path.join(config_data["temp_path"], "dedup.sqlite3"),
+                config_data["dedup_ttl_days"], config_data["dedup_max_entries"]
+            )
+        # With temp_solution nothing is moved to error_path, failed pairs stay in the inbox
+        if config_data["retry_failed_documents"] and not self.temp_solution:
+            self.ledger = RetryLedger(os.path.join(config_data["temp_path"], "retry.sqlite3"), config_data["retry_max_attempts"])
+            if not self.watch:
+                # Moves from error_path may cross devices, keep them off the event loop
+                await asyncio.to_thread(requeue_failed, self.ledger, self.folder_path, config_data["retry_after_minutes"] * 60)
+
+        self.archive_queue = asyncio.Queue(maxsize=config_data["pipeline_queue_size"])
+        self.archiver = asyncio.create_task(archive_stage(
+            self.archive_queue, self.folder_path, self.archive_dirs, self.temp_solution,
+            self.index, self.ledger, config_data["archive_workers"]
+        ))
+        if config_data["archive_compress"]:
+            self.compressor = asyncio.create_task(compress_loop(
+                self.backup_path, config_data["archive_compress"], config_data["archive_compress_after_days"],
+                3600 if self.watch else None
+            ))
+        return True
+
+    async def upload(self, item, folder_path=None):
+        return await upload_with_restapi(
+            self.base_url, item, folder_path or self.folder_path, self.client, self.url, self.chunk_size,
+            self.token_manager, self.dedup, self.mapping, defer_index=self.indexer is not None,
+            temp_path=self.config_data["temp_path"]
+        )
+
+    async def index_pending(self, pending):
+        return await index_pending_document(pending, self.client, self.url, self.token_manager, self.dedup)
+
+    async def route_result(self, result):
+        # Uploaded but not yet indexed documents take the detour through the
+        # IndexingStage, everything else goes straight to the archiver
+        if result.get("index_pending"):
+            await self.indexer.submit(result, self.index_pending, self.archive_queue.put)
+        else:
+            await self.archive_queue.put(result)
+
+    async def parse(self, scheduler, executor, indexer=None):
+        config_data = self.config_data
+        self.indexer = indexer
+        if not self.watch:
+            await self._parse_folder(self.folder_path, scan_inbox(self.folder_path, self.index), scheduler, executor)
+            return
+        if self.ledger is not None:
+            self.requeuer = asyncio.create_task(requeue_loop(
+                self.ledger, self.folder_path, config_data["retry_after_minutes"] * 60,
+                max(60, config_data["watch_rescan_interval"])
+            ))
+        while True:
+            # One pass per inbox folder; only a dated inbox ever moves on
+            folder_path = self.folder_path = self.inbox_folder()
+            xml_names = watch_inbox(
+                folder_path, self.index, config_data["watch_poll_interval"],
+                config_data["watch_rescan_interval"], config_data["watch_settle_seconds"],
+                stop=lambda: self.inbox_folder() != folder_path,
+                # With temp_solution failed pairs stay in the inbox and there
+                # is no RetryLedger, the index re-offers them instead
+                retry_after_seconds=config_data["retry_after_minutes"] * 60 if config_data["retry_failed_documents"] else None,
+                max_attempts=config_data["retry_max_attempts"]
+            )
+            await self._parse_folder(folder_path, xml_names, scheduler, executor)
+
+    async def _parse_folder(self, folder_path, xml_names, scheduler, executor):
+        config_data = self.config_data
+        await parse_stage(
+            xml_names, folder_path, scheduler, self.host, self.archive_queue.put,
+            workers=config_data["parse_workers"], queue_size=config_data["pipeline_queue_size"],
+            executor=executor, engine=config_data["parse_engine"], index=self.index,
+            mapping=self.mapping, upload_func=functools.partial(self.upload, folder_path=folder_path),
+            on_result=self.route_result,
+            budget_func=lambda size: upload_buffer_bytes(size, self.chunk_size)
+        )
+
+    async def finish(self):
+        # Called once the shared scheduler and indexing stage are idle, i.e.
+        # every result is queued
+        await self.archive_queue.put(None)
+        await self.archiver
+        if self.compressor is not None:
+            await self.compressor
+
+    async def close(self):
+        for task in (self.requeuer, self.compressor, self.archiver):
+            if task is not None and not task.done():
+                task.cancel()
+        for store in (self.index, self.dedup, self.ledger):
+            if store is not None:
+                store.close()
+        if self.client is not None:
+            await self.client.aclose()
+
+
+DEFAULT_CONFIG_PATH = os.path.join(r"C:\\DTW\\xml2dwctrl", "config.json")
+
+
+async def main(config_path=DEFAULT_CONFIG_PATH, watch=False):
+    # config_path is one config.json or a list of them; see load_profiles
+    global CONFIG, METRICS, FIELD_MAPPING, BANDWIDTH
+
+    config_paths = [config_path] if isinstance(config_path, str) else list(config_path)
+    log_file_path = os.path.join(os.path.dirname(config_paths[0]), "LOGS")
+    try:
+        config_data, profile_data = load_profiles(config_paths)
+    except (OSError, ValueError) as e:
+        # No settings to take the log options from, so log with the defaults
+        setup_logging(log_file_path, logging.INFO, 10 * 1024 * 1024, 10, False)
+        logging.critical("Konfiguration konnte nicht geladen werden: %s", str(e))
+        return
+
+    # Logging setup
+    setup_logging(
+        log_file_path, set_log_level(config_data["log_level"]),
+        config_data["log_max_bytes"], config_data["log_backup_count"], config_data["log_json_lines"]
+    )
 
-    config_data = read_config(os.path.join(r"C:\\DTW\\xml2dwctrl", "config.json"))
+    # Transfer settings shared by all profiles; credentials are per profile
     CONFIG = {
         "company_url": config_data["company_url"],
         "file_cabinet_guid": config_data["file_cabinet_guid"],
         "username": config_data["username"],
         "password": config_data["password"],
-        "cert_file": config_data["cert_file_fiddler"] if config_data["fiddler"] else config_data["cert_file"],
         "token_endpoint": config_data["token_endpoint"],
         "token_file": config_data["token_file"],
         "temp_path": config_data["temp_path"],
         "fiddler": config_data["fiddler"],
+        "small_file_threshold": config_data["small_file_threshold"],
+        "adaptive_chunks": config_data["adaptive_chunks"],
+        "chunk_size_min": config_data["chunk_size_min"],
+        "chunk_size_max": config_data["chunk_size_max"],
+        "chunk_target_seconds": config_data["chunk_target_seconds"],
+        "chunk_retries": config_data["chunk_retries"],
+        "retry_backoff": config_data["retry_backoff"],
+        "retry_backoff_max": config_data["retry_backoff_max"],
+        "retry_jitter": config_data["retry_jitter"],
+        "retry_after_max": config_data["retry_after_max"],
     }
 
-    folder_path = config_data["folder_path"]
-    backup_path = config_data["backup_path"]
-    error_path = config_data["error_path"]
-    temp_solution = config_data["temp_solution"]
-    chunk_size = config_data["chunk_size"]
-    company_url = config_data["company_url"]
-    file_cabinet_guid = config_data["file_cabinet_guid"]
-    cert_file = CONFIG["cert_file"]
-    log_level = config_data["log_level"]
-    log_file_path = r"C:\\DTW\\xml2dwctrl\\LOGS"
-    base_url = f"https://{company_url}/"
-
-    # Logging setup
-    if not os.path.exists(log_file_path):
-        os.makedirs(log_file_path)
-    log_file_dest = os.path.join(log_file_path, 'log.txt')
-    logging.basicConfig(filename=log_file_dest, level=set_log_level(log_level), format='%(asctime)s - %(levelname)s - %(message)s')
-
-    # Ensure token exists
-    token_info = ensure_token()
-    if not token_info:
-        logging.critical("Token retrieval failed. Exiting.")
-        return
-    access_token = token_info["access_token"]
-
-    # Ensure backup/error folders
-    os.makedirs(backup_path, exist_ok=True)
-    os.makedirs(error_path, exist_ok=True)
-
     current_datetime = datetime.now().strftime("%Y%m%d%H%M%S")
-    subbackup_path = os.path.join(backup_path, current_datetime)
-    suberror_path = os.path.join(error_path, current_datetime)
-
-    current_date = datetime.now().strftime("%Y%m%d")
-
-    if temp_solution:
-        folder_path = os.path.join(folder_path, current_date)
-
-    # Gather XML parse tasks
-    tasks = []
-    for f in os.listdir(folder_path):
-        if f.endswith(".xml"):
-            tasks.append(get_data_from_xml(folder_path, f))
-
-    results = await asyncio.gather(*tasks)
-
-    uploaded_files = []
-
-    client_config = {
-        'verify': cert_file if cert_file else True,
-        'proxies': {
-            "http://": "http://localhost:8888",
-            "https://": "http://localhost:8888",
-        } if config_data["fiddler"] else None
-    }
+    try:
+        FIELD_MAPPING = FieldMapping(config_data["index_fields"] or DEFAULT_FIELD_MAPPING)
+        profiles = [Profile(name, data, config_data, watch, current_datetime) for name, data in profile_data]
+    except (ValueError, TypeError, etree.XPathSyntaxError) as e:
+        logging.critical("Ungueltige Feldzuordnung in index_fields: %s", str(e))
+        return
 
-    async with httpx.AsyncClient(**client_config) as client:
-        url = f"https://{company_url}/docuware/platform/FileCabinets/{file_cabinet_guid}/Documents"
-        logging.debug("Verbinden mit: %s", url)
-
-        batch_size = 20
-        for i in range(0, len(results), batch_size):
-            batch = results[i:i + batch_size]
-            batch_tasks = [upload_with_restapi(base_url, item, folder_path, client, url, chunk_size, access_token) for item in batch]
-            batch_results = await asyncio.gather(*batch_tasks)
-            uploaded_files.extend(batch_results)
-
-    # Handle results + file moves
-    for data in uploaded_files:
-        if data["data"]["status"] == "Success":
-            logging.info("[ERFOLG] - DATEI: %s - 'get_data_from_xml()' - Status: %s - Nachricht: %s", data["data"]["OriginalFileName"], data["data"]["status"], data["data"].get("error", "Erfolg"))
-        else:
-            logging.error("[FEHLER] - DATEI: %s - 'get_data_from_xml()' - Status: %s - Nachricht: %s", data["data"]["OriginalFileName"], data["data"]["status"], data["data"].get("error", "Fehler"))
+    try:
+        BANDWIDTH = BandwidthLimiter(
+            config_data["bandwidth_limit"], config_data["bandwidth_windows"],
+            config_data["bandwidth_burst"], config_data["bandwidth_inflight_seconds"]
+        )
+    except (ValueError, TypeError, AttributeError) as e:
+        logging.critical("Ungueltige Zeitfenster in bandwidth.windows: %s", str(e))
+        return
 
-        if data["status_code"] == 200:
-            logging.info("[ERFOLG] - DATEI: %s - 'upload_with_restapi()' - Status: %s - Nachricht: %s", data["data"]["OriginalFileName"], data["status_code"], data["text"])
-        else:
-            logging.error("[FEHLER] - DATEI: %s - 'upload_with_restapi()' - Status: %s - Nachricht: %s", data["data"]["OriginalFileName"], data["status_code"], data["text"])
+    METRICS = RunMetrics()
+    # Counters and chunk sizing start fresh for every run in the same process
+    RUN_STATS.update(small_uploads=0, requests_saved=0, duplicates_skipped=0)
+    CHUNK_SESSION["bandwidth"] = None
+    # One breaker per DocuWare host, created on first use
+    CIRCUIT_SETTINGS.clear()
+    CIRCUIT_SETTINGS.update(
+        failure_threshold=config_data["circuit_failure_threshold"], reset_seconds=config_data["circuit_reset_seconds"],
+        max_reset_seconds=config_data["circuit_max_reset_seconds"], give_up_seconds=config_data["circuit_give_up_seconds"]
+    )
+    CIRCUITS.clear()
+    # Always the latest run; write_json replaces it atomically, so runs every
+    # few minutes do not pile up files in LOGS
+    metrics_path = os.path.join(log_file_path, "metrics.json") if config_data["metrics_enabled"] else ""
+
+    def write_metrics():
+        write_run_metrics(metrics_path, config_data["metrics_prometheus_file"])
+
+    if len(profiles) > 1:
+        logging.info("Profile: %s", ", ".join(profile.name for profile in profiles))
+    for name, data in profile_data:
+        if data["ignored_sections"]:
+            logging.warning(
+                "Profil %s: Abschnitte %s gelten fuer alle Profile und werden nur aus der ersten Konfiguration gelesen - Abweichungen ignoriert",
+                name, ", ".join(data["ignored_sections"])
+            )
+
+    scheduler = UploadScheduler(
+        None,
+        workers=config_data["upload_workers"],
+        max_per_host=config_data["max_uploads_per_host"],
+        max_inflight_bytes=config_data["max_inflight_bytes"],
+        queue_size=config_data["pipeline_queue_size"],
+        limiter=BANDWIDTH,
+    )
+    indexer = IndexingStage(
+        config_data["indexing_workers"], config_data["pipeline_queue_size"]
+    ) if config_data["indexing_deferred"] else None
+    reporter = None
+    parse_executor = None
+
+    async def guarded(profile, step, coro):
+        # A broken profile (missing inbox, unreadable store) only drops itself
+        try:
+            return await coro
+        except Exception as e:
+            logging.critical("Profil %s: %s fehlgeschlagen, Profil wird uebersprungen: %s", profile.name, step, str(e), exc_info=True)
+            return False
 
-        if not temp_solution:
-            try:
-                xml_src = os.path.join(folder_path, data["data"]["OriginalFileName"]) 
-                bin_src = os.path.join(folder_path, data["data"]["FileName"]) 
-                if data["data"]["status"] == "Success" and data["status_code"] == 200:
-                    if os.path.isfile(xml_src) and os.path.isfile(bin_src):
-                        os.makedirs(subbackup_path, exist_ok=True)
-                        shutil.move(xml_src, os.path.join(subbackup_path, data["data"]["OriginalFileName"]))
-                        shutil.move(bin_src, os.path.join(subbackup_path, data["data"]["FileName"]))
-                elif data["data"]["status"] == "Failed" or data["status_code"] != 200:
-                    if os.path.isfile(xml_src) and os.path.isfile(bin_src):
-                        os.makedirs(suberror_path, exist_ok=True)
-                        shutil.move(xml_src, os.path.join(suberror_path, data["data"]["OriginalFileName"]))
-                        shutil.move(bin_src, os.path.join(suberror_path, data["data"]["FileName"]))
-            except Exception as e:
-                logging.error("DATEI: %s - Fehler: %s", data["data"]["OriginalFileName"], str(e))
+    try:
+        opened = await asyncio.gather(*(guarded(profile, "Start", profile.open()) for profile in profiles))
+        active = [profile for profile, ok in zip(profiles, opened) if ok]
+        if not active:
+            logging.critical("Kein Profil konnte gestartet werden. Exiting.")
+            return
+
+        scheduler.start()
+        if indexer is not None:
+            indexer.start()
+        if watch:
+            reporter = asyncio.create_task(report_loop(scheduler, config_data["watch_report_minutes"], write_metrics))
+        parse_executor = create_parse_executor(config_data["parse_executor"], config_data["parse_workers"])
+        await asyncio.gather(*(
+            guarded(profile, "Einlesen", profile.parse(scheduler, parse_executor, indexer)) for profile in active
+        ))
+        await scheduler.join()
+        if indexer is not None:
+            await indexer.join()
+        for profile in active:
+            await profile.finish()
+    finally:
+        if reporter is not None:
+            reporter.cancel()
+        if parse_executor is not None:
+            parse_executor.shutdown(cancel_futures=True)
+        for profile in profiles:
+            await profile.close()
+    scheduler.log_throughput()
+    logging.info("Kleine Dateien: %d per Einzelanfrage hochgeladen, %d Anfragen eingespart", RUN_STATS["small_uploads"], RUN_STATS["requests_saved"])
+    logging.info("Duplikate: %d Uploads uebersprungen", RUN_STATS["duplicates_skipped"])
+    if indexer is not None:
+        logging.info("Indexierung: %d Dokumente nach dem Upload separat indexiert", indexer.documents_done)
+
+    peak_rss = get_peak_rss()
+    if peak_rss is not None:
+        logging.info("Speicher: Peak RSS %.1f MB", peak_rss / (1024 * 1024))
+    for phase, hist in METRICS.snapshot()["phases"].items():
+        logging.info("Phase %s: %d x, Mittel %.1f ms, p95 %.1f ms, max %.1f ms", phase, hist["count"], hist["mean_seconds"] * 1000, hist["p95_seconds"] * 1000, hist["max_seconds"] * 1000)
+    write_metrics()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Upload PDS XML/binary pairs to a DocuWare file cabinet")
+    parser.add_argument("--config", action="append", help="path to config.json, repeat for several profiles (default: %s)" % DEFAULT_CONFIG_PATH)
+    parser.add_argument("--watch", action="store_true", help="run as a service and upload new files as they arrive")
+    args = parser.parse_args(argv)
+    args.config = args.config or [DEFAULT_CONFIG_PATH]
+    return args
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    args = parse_args()
+    try:
+        asyncio.run(main(args.config, args.watch))
+    except KeyboardInterrupt:
+        logging.info("Dienst beendet.")